@@ -0,0 +1,75 @@
+"""Сравнение старого (BeautifulSoup) и нового (lxml, один проход) извлечения текста гайдов Game8.
+
+Запуск: python benchmarks/bench_guide_extraction.py [page1.html page2.html ...] [--repeat 20]
+Без аргументов используются страницы из benchmarks/fixtures. Свои страницы сохраняются заранее,
+например: curl -o page.html https://game8.co/games/Arknights-Endfield/archives/...
+Для старого варианта нужен пакет bs4 (pip install bs4).
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+from main import _extract_guide_sync  # noqa: E402
+
+
+def legacy_extract(html: str):
+    """Прежний алгоритм из fetch_and_translate_guide: полное дерево BeautifulSoup и несколько проходов"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'lxml')
+    title_meta = soup.find('meta', property='og:title')
+    en_title = title_meta['content'].replace(" | Game8", "") if title_meta else "Гайд Endfield"
+    img_meta = soup.find('meta', property='og:image')
+    cover_url = img_meta['content'] if img_meta else None
+    content = soup.find('div', class_='archive-style-wrapper')
+    if not content:
+        content = soup.find('article') or soup.body
+    for a_tag in content.find_all('a'):
+        a_tag.unwrap()
+    for img in content.find_all('img'):
+        img.decompose()
+    for tag in content(['script', 'style', 'ins', 'iframe', 'nav', 'div.toc']):
+        tag.decompose()
+    for tag in content.find_all('div', class_=['a-ad', 'a-ad__container', 'a-linkHeader', 'article-bottom-links']):
+        tag.decompose()
+    return en_title, cover_url, str(content)[:40000]
+
+
+def measure(func, html: str, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(html)
+    elapsed_ms = (time.perf_counter() - start) * 1000 / repeat
+
+    tracemalloc.start()
+    func(html)
+    peak_kb = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    return elapsed_ms, peak_kb, len(result[2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('pages', nargs='*', help='сохранённые HTML-страницы Game8 (по умолчанию — benchmarks/fixtures/*.html)')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    pages = args.pages or sorted(glob.glob(os.path.join(FIXTURES, '*.html')))
+
+    print(f"{'страница':<32} {'вариант':<8} {'мс':>8} {'пик КБ':>10} {'символов':>10}")
+    for path in pages:
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        name = os.path.basename(path)[:32]
+        for label, func in (('bs4', legacy_extract), ('lxml', _extract_guide_sync)):
+            ms, peak, size = measure(func, html, args.repeat)
+            print(f"{name:<32} {label:<8} {ms:>8.1f} {peak:>10.0f} {size:>10}")
+
+
+if __name__ == '__main__':
+    main()
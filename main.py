@@ -1,37 +1,125 @@
+import time
+_PROCESS_START = time.perf_counter()
 import discord
 from discord.ext import commands, tasks
 from discord.ui import Button, View
 import asyncio
+import bisect
 import datetime
 from datetime import time as datetime_time
 import sys
 import aiohttp
 import pytz
-import math
 import io
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from typing import Dict, List, Optional
+import hashlib
+import functools
+from collections import OrderedDict, deque
+from urllib.parse import urljoin, urlparse
+from typing import Dict, List, Optional, Tuple
 import os
-import subprocess
-from PIL import Image, ImageDraw, ImageFont
+import shutil
+import zlib
 import asyncpg
-from bs4 import BeautifulSoup
-from google import genai
+
+# Тяжёлые зависимости (matplotlib, PIL, lxml, google-genai) импортируются лениво при первом использовании
+startup_timings = {'import': time.perf_counter() - _PROCESS_START}
 
 # ==================== НАСТРОЙКА ИИ ДЛЯ ПЕРЕВОДОВ ====================
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-if GEMINI_API_KEY:
-    ai_client = genai.Client(api_key=GEMINI_API_KEY)
-else:
-    ai_client = None
+_ai_client = None
+if not GEMINI_API_KEY:
     print("⚠️ GEMINI_API_KEY не найден. Перевод гайдов работать не будет.")
 
+def get_ai_client():
+    """Клиент Gemini создаётся при первом переводе, а не при старте процесса"""
+    global _ai_client
+    if _ai_client is None and GEMINI_API_KEY:
+        from google import genai
+        _ai_client = genai.Client(api_key=GEMINI_API_KEY)
+    return _ai_client
+
+# ==================== МИГРАЦИИ СХЕМЫ ====================
+# Каждая версия применяется один раз и фиксируется в schema_migrations. Новые изменения схемы — только новой версией в конце списка
+MIGRATIONS = [
+    (1, """
+        CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, messages INT DEFAULT 0, voice_minutes INT DEFAULT 0, reputation INT DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS rep_cooldowns (user_id BIGINT PRIMARY KEY, last_rep TIMESTAMP);
+        CREATE TABLE IF NOT EXISTS guild_config (
+            guild_id BIGINT PRIMARY KEY, log_channel BIGINT, backup_channel BIGINT, guides_channel BIGINT,
+            voice_events BOOLEAN DEFAULT TRUE, role_events BOOLEAN DEFAULT TRUE,
+            member_events BOOLEAN DEFAULT TRUE, channel_events BOOLEAN DEFAULT TRUE,
+            server_events BOOLEAN DEFAULT TRUE, message_events BOOLEAN DEFAULT FALSE,
+            command_events BOOLEAN DEFAULT TRUE, telegram_notify_role BOOLEAN DEFAULT FALSE,
+            telegram_daily_report BOOLEAN DEFAULT TRUE, economy_enabled BOOLEAN DEFAULT TRUE,
+            achievements_enabled BOOLEAN DEFAULT TRUE
+        );
+        CREATE TABLE IF NOT EXISTS warns (id SERIAL PRIMARY KEY, guild_id BIGINT, user_id BIGINT, moderator_id BIGINT, reason TEXT, timestamp TIMESTAMP DEFAULT NOW());
+        CREATE TABLE IF NOT EXISTS levels (user_id BIGINT PRIMARY KEY, xp INT DEFAULT 0, level INT DEFAULT 0, last_xp_time TIMESTAMP DEFAULT NOW());
+        CREATE TABLE IF NOT EXISTS user_history (id SERIAL PRIMARY KEY, user_id BIGINT, guild_id BIGINT, date DATE DEFAULT CURRENT_DATE, voice_minutes INT DEFAULT 0, messages INT DEFAULT 0, UNIQUE(user_id, guild_id, date));
+        CREATE TABLE IF NOT EXISTS economy (user_id BIGINT PRIMARY KEY, balance BIGINT DEFAULT 0, total_earned BIGINT DEFAULT 0, last_daily TIMESTAMP);
+        CREATE TABLE IF NOT EXISTS shop_roles (id SERIAL PRIMARY KEY, guild_id BIGINT, role_id BIGINT, price BIGINT, description TEXT, created_at TIMESTAMP DEFAULT NOW());
+        CREATE TABLE IF NOT EXISTS purchased_roles (id SERIAL PRIMARY KEY, guild_id BIGINT, user_id BIGINT, role_id BIGINT, purchased_at TIMESTAMP DEFAULT NOW(), UNIQUE(guild_id, user_id, role_id));
+        CREATE TABLE IF NOT EXISTS achievements (id SERIAL PRIMARY KEY, name TEXT UNIQUE, description TEXT, xp_reward INT DEFAULT 0, coin_reward BIGINT DEFAULT 0, icon TEXT DEFAULT '🏆', hidden BOOLEAN DEFAULT FALSE, created_at TIMESTAMP DEFAULT NOW());
+        CREATE TABLE IF NOT EXISTS user_achievements (id SERIAL PRIMARY KEY, user_id BIGINT, achievement_id INT, earned_at TIMESTAMP DEFAULT NOW(), UNIQUE(user_id, achievement_id));
+        CREATE TABLE IF NOT EXISTS server_history (id SERIAL PRIMARY KEY, guild_id BIGINT, date DATE DEFAULT CURRENT_DATE, total_messages INT DEFAULT 0, total_voice_minutes INT DEFAULT 0, active_users INT DEFAULT 0, new_members INT DEFAULT 0, UNIQUE(guild_id, date));
+        CREATE TABLE IF NOT EXISTS profile_themes (id SERIAL PRIMARY KEY, name TEXT UNIQUE, accent_color INT, bg_color INT, card_color INT, overlay_url TEXT, style TEXT DEFAULT 'default', price BIGINT DEFAULT 0, preview_url TEXT, purchasable BOOLEAN DEFAULT TRUE);
+        CREATE TABLE IF NOT EXISTS user_profile (user_id BIGINT PRIMARY KEY, theme_id INT DEFAULT 1, custom_accent_color INT, custom_bg_color INT, FOREIGN KEY (theme_id) REFERENCES profile_themes(id));
+        CREATE TABLE IF NOT EXISTS posted_guides (url TEXT PRIMARY KEY, posted_at TIMESTAMP DEFAULT NOW());
+    """),
+    (2, """
+        ALTER TABLE guild_config ADD COLUMN IF NOT EXISTS backup_channel BIGINT;
+        ALTER TABLE guild_config ADD COLUMN IF NOT EXISTS guides_channel BIGINT;
+        ALTER TABLE guild_config ADD COLUMN IF NOT EXISTS economy_enabled BOOLEAN DEFAULT TRUE;
+        ALTER TABLE guild_config ADD COLUMN IF NOT EXISTS achievements_enabled BOOLEAN DEFAULT TRUE;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS reputation INT DEFAULT 0;
+    """),
+    (3, """
+        CREATE OR REPLACE FUNCTION level_for_xp(xp BIGINT) RETURNS INT AS $$
+            SELECT FLOOR((SQRT(100 * (2 * xp + 25)) + 50) / 100)::INT
+        $$ LANGUAGE SQL IMMUTABLE;
+    """),
+    (4, """
+        CREATE TABLE IF NOT EXISTS voice_sessions (guild_id BIGINT, user_id BIGINT, started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(), PRIMARY KEY (guild_id, user_id));
+    """),
+    (5, """
+        CREATE INDEX IF NOT EXISTS idx_users_voice_minutes ON users (voice_minutes DESC);
+        CREATE INDEX IF NOT EXISTS idx_users_messages ON users (messages DESC);
+        CREATE INDEX IF NOT EXISTS idx_economy_balance ON economy (balance DESC);
+        CREATE INDEX IF NOT EXISTS idx_levels_level_xp ON levels (level DESC, xp DESC);
+    """),
+    (6, """
+        CREATE TABLE IF NOT EXISTS guide_queue (url TEXT PRIMARY KEY, enqueued_at TIMESTAMP DEFAULT NOW(), attempts INT DEFAULT 0, next_attempt_at TIMESTAMP DEFAULT NOW(), last_error TEXT);
+        CREATE TABLE IF NOT EXISTS crawler_state (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, updated_at TIMESTAMP DEFAULT NOW());
+    """),
+    (7, """
+        CREATE TABLE IF NOT EXISTS guide_translations (url TEXT PRIMARY KEY, source_hash TEXT NOT NULL, title TEXT, body TEXT, cover_url TEXT, translated_at TIMESTAMP DEFAULT NOW(), checked_at TIMESTAMP DEFAULT NOW());
+    """),
+    (8, """
+        ALTER TABLE achievements ADD COLUMN IF NOT EXISTS metric TEXT;
+        ALTER TABLE achievements ADD COLUMN IF NOT EXISTS threshold INT;
+    """),
+    (9, """
+        UPDATE users SET reputation = 0 WHERE reputation IS NULL;
+        ALTER TABLE users ALTER COLUMN reputation SET NOT NULL;
+        CREATE INDEX IF NOT EXISTS idx_users_reputation ON users (reputation DESC);
+    """),
+    (10, """
+        CREATE TABLE IF NOT EXISTS coin_ledger (id BIGSERIAL PRIMARY KEY, user_id BIGINT NOT NULL, amount BIGINT NOT NULL, reason TEXT NOT NULL, ref TEXT, created_at TIMESTAMP DEFAULT NOW());
+        CREATE INDEX IF NOT EXISTS idx_coin_ledger_user ON coin_ledger (user_id, id);
+        CREATE TABLE IF NOT EXISTS coin_pending (user_id BIGINT, reason TEXT, amount BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (user_id, reason));
+        INSERT INTO coin_ledger (user_id, amount, reason) SELECT user_id, balance, 'opening' FROM economy WHERE balance <> 0;
+    """),
+    (11, """
+        ALTER TABLE guide_queue ADD COLUMN IF NOT EXISTS position INT NOT NULL DEFAULT 0;
+    """),
+]
+
 # ==================== РАБОТА С БАЗОЙ ДАННЫХ ====================
 class Database:
     def __init__(self):
         self.pool = None
+        self.listener = None
+        self.listener_tasks = set()
 
     async def connect(self):
         """Создаёт пул соединений с PostgreSQL с повторными попытками"""
@@ -57,56 +145,116 @@ class Database:
         return self.pool
 
     async def init_db(self):
+        """Применяет недостающие версии из MIGRATIONS. Уже применённые версии не выполняются повторно"""
         pool = await self.connect()
         if pool is None: return
 
         async with pool.acquire() as conn:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, messages INT DEFAULT 0, voice_minutes INT DEFAULT 0, reputation INT DEFAULT 0);
-                CREATE TABLE IF NOT EXISTS rep_cooldowns (user_id BIGINT PRIMARY KEY, last_rep TIMESTAMP);
-                CREATE TABLE IF NOT EXISTS guild_config (
-                    guild_id BIGINT PRIMARY KEY, log_channel BIGINT, backup_channel BIGINT, guides_channel BIGINT,
-                    voice_events BOOLEAN DEFAULT TRUE, role_events BOOLEAN DEFAULT TRUE,
-                    member_events BOOLEAN DEFAULT TRUE, channel_events BOOLEAN DEFAULT TRUE,
-                    server_events BOOLEAN DEFAULT TRUE, message_events BOOLEAN DEFAULT FALSE,
-                    command_events BOOLEAN DEFAULT TRUE, telegram_notify_role BOOLEAN DEFAULT FALSE,
-                    telegram_daily_report BOOLEAN DEFAULT TRUE, economy_enabled BOOLEAN DEFAULT TRUE,
-                    achievements_enabled BOOLEAN DEFAULT TRUE
-                );
-                CREATE TABLE IF NOT EXISTS warns (id SERIAL PRIMARY KEY, guild_id BIGINT, user_id BIGINT, moderator_id BIGINT, reason TEXT, timestamp TIMESTAMP DEFAULT NOW());
-                CREATE TABLE IF NOT EXISTS levels (user_id BIGINT PRIMARY KEY, xp INT DEFAULT 0, level INT DEFAULT 0, last_xp_time TIMESTAMP DEFAULT NOW());
-                CREATE TABLE IF NOT EXISTS user_history (id SERIAL PRIMARY KEY, user_id BIGINT, guild_id BIGINT, date DATE DEFAULT CURRENT_DATE, voice_minutes INT DEFAULT 0, messages INT DEFAULT 0, UNIQUE(user_id, guild_id, date));
-                CREATE TABLE IF NOT EXISTS economy (user_id BIGINT PRIMARY KEY, balance BIGINT DEFAULT 0, total_earned BIGINT DEFAULT 0, last_daily TIMESTAMP);
-                CREATE TABLE IF NOT EXISTS shop_roles (id SERIAL PRIMARY KEY, guild_id BIGINT, role_id BIGINT, price BIGINT, description TEXT, created_at TIMESTAMP DEFAULT NOW());
-                CREATE TABLE IF NOT EXISTS purchased_roles (id SERIAL PRIMARY KEY, guild_id BIGINT, user_id BIGINT, role_id BIGINT, purchased_at TIMESTAMP DEFAULT NOW(), UNIQUE(guild_id, user_id, role_id));
-                CREATE TABLE IF NOT EXISTS achievements (id SERIAL PRIMARY KEY, name TEXT UNIQUE, description TEXT, xp_reward INT DEFAULT 0, coin_reward BIGINT DEFAULT 0, icon TEXT DEFAULT '🏆', hidden BOOLEAN DEFAULT FALSE, created_at TIMESTAMP DEFAULT NOW());
-                CREATE TABLE IF NOT EXISTS user_achievements (id SERIAL PRIMARY KEY, user_id BIGINT, achievement_id INT, earned_at TIMESTAMP DEFAULT NOW(), UNIQUE(user_id, achievement_id));
-                CREATE TABLE IF NOT EXISTS server_history (id SERIAL PRIMARY KEY, guild_id BIGINT, date DATE DEFAULT CURRENT_DATE, total_messages INT DEFAULT 0, total_voice_minutes INT DEFAULT 0, active_users INT DEFAULT 0, new_members INT DEFAULT 0, UNIQUE(guild_id, date));
-                CREATE TABLE IF NOT EXISTS profile_themes (id SERIAL PRIMARY KEY, name TEXT UNIQUE, accent_color INT, bg_color INT, card_color INT, overlay_url TEXT, style TEXT DEFAULT 'default', price BIGINT DEFAULT 0, preview_url TEXT, purchasable BOOLEAN DEFAULT TRUE);
-                CREATE TABLE IF NOT EXISTS user_profile (user_id BIGINT PRIMARY KEY, theme_id INT DEFAULT 1, custom_accent_color INT, custom_bg_color INT, FOREIGN KEY (theme_id) REFERENCES profile_themes(id));
-                CREATE TABLE IF NOT EXISTS posted_guides (url TEXT PRIMARY KEY, posted_at TIMESTAMP DEFAULT NOW());
-            """)
-            
-            for col in ["backup_channel BIGINT", "guides_channel BIGINT", "economy_enabled BOOLEAN DEFAULT TRUE", "achievements_enabled BOOLEAN DEFAULT TRUE"]:
-                try: await conn.execute(f"ALTER TABLE guild_config ADD COLUMN IF NOT EXISTS {col}")
-                except Exception: pass
-            try: await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS reputation INT DEFAULT 0")
-            except Exception: pass
-            
+            await conn.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INT PRIMARY KEY, applied_at TIMESTAMP DEFAULT NOW())")
+            if (await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")) >= MIGRATIONS[-1][0]:
+                print("✅ База данных инициализирована (схема актуальна)")
+                return
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+                applied = {r['version'] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+                for version, sql in MIGRATIONS:
+                    if version in applied: continue
+                    await conn.execute(sql)
+                    await conn.execute("INSERT INTO schema_migrations (version) VALUES ($1)", version)
+                    print(f"🗄️ Применена миграция {version}")
             print("✅ База данных инициализирована")
 
     # --- МЕТОДЫ ДЛЯ ГАЙДОВ ---
-    async def is_guide_posted(self, url: str):
+    async def enqueue_guides(self, urls: List[str]):
+        """Одним запросом отбрасывает уже опубликованные и уже поставленные в очередь ссылки, остальные ставит в очередь.
+        position хранит порядок на странице индекса: у всей пачки одинаковый enqueued_at"""
         pool = await self.connect()
-        if not pool: return True
+        if not pool or not urls: return []
         async with pool.acquire() as conn:
-            return bool(await conn.fetchval("SELECT 1 FROM posted_guides WHERE url = $1", url))
+            rows = await conn.fetch("""
+                INSERT INTO guide_queue (url, position)
+                SELECT u, ord FROM unnest($1::text[]) WITH ORDINALITY AS t(u, ord)
+                WHERE NOT EXISTS (SELECT 1 FROM posted_guides p WHERE p.url = t.u)
+                ON CONFLICT (url) DO NOTHING RETURNING url
+            """, urls)
+            return [r['url'] for r in rows]
+
+    async def seed_posted_guides(self, urls: List[str]):
+        """Первый обход индекса: отмечает ссылки опубликованными, чтобы не переводить и не постить весь архив разом"""
+        pool = await self.connect()
+        if pool and urls:
+            async with pool.acquire() as conn:
+                await conn.execute("INSERT INTO posted_guides (url) SELECT unnest($1::text[]) ON CONFLICT DO NOTHING", urls)
 
-    async def mark_guide_posted(self, url: str):
+    async def get_queued_guides(self, limit: int, max_attempts: int):
+        pool = await self.connect()
+        if not pool: return []
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("SELECT url FROM guide_queue WHERE next_attempt_at <= NOW() AND attempts < $2 ORDER BY enqueued_at, position LIMIT $1", limit, max_attempts)
+            return [r['url'] for r in rows]
+
+    async def complete_queued_guide(self, url: str):
+        pool = await self.connect()
+        if pool:
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute("INSERT INTO posted_guides (url) VALUES ($1) ON CONFLICT DO NOTHING", url)
+                    await conn.execute("DELETE FROM guide_queue WHERE url = $1", url)
+
+    async def fail_queued_guide(self, url: str, error: str):
+        """Откладывает гайд с экспоненциальной паузой: 10 мин, 20 мин, 40 мин..."""
         pool = await self.connect()
         if pool:
             async with pool.acquire() as conn:
-                await conn.execute("INSERT INTO posted_guides (url) VALUES ($1) ON CONFLICT DO NOTHING", url)
+                await conn.execute("""
+                    UPDATE guide_queue SET attempts = attempts + 1, last_error = $2,
+                        next_attempt_at = NOW() + INTERVAL '10 minutes' * POWER(2, attempts)
+                    WHERE url = $1
+                """, url, error[:500])
+
+    async def get_crawler_state(self, url: str):
+        pool = await self.connect()
+        if not pool: return {}
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT etag, last_modified FROM crawler_state WHERE url = $1", url)
+            return dict(row) if row else {}
+
+    async def save_crawler_state(self, url: str, etag: str, last_modified: str):
+        pool = await self.connect()
+        if pool:
+            async with pool.acquire() as conn:
+                await conn.execute("""
+                    INSERT INTO crawler_state (url, etag, last_modified, updated_at) VALUES ($1, $2, $3, NOW())
+                    ON CONFLICT (url) DO UPDATE SET etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified, updated_at = NOW()
+                """, url, etag, last_modified)
+
+    async def get_guide_translation(self, url: str):
+        """Возвращает сохранённый перевод и возраст последней проверки источника в секундах"""
+        pool = await self.connect()
+        if not pool: return None
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT source_hash, title, body, cover_url, EXTRACT(EPOCH FROM NOW() - checked_at)::float AS age
+                FROM guide_translations WHERE url = $1
+            """, url)
+            return dict(row) if row else None
+
+    async def save_guide_translation(self, url: str, source_hash: str, title: str, body: str, cover_url: str):
+        pool = await self.connect()
+        if pool:
+            async with pool.acquire() as conn:
+                await conn.execute("""
+                    INSERT INTO guide_translations (url, source_hash, title, body, cover_url, translated_at, checked_at)
+                    VALUES ($1, $2, $3, $4, $5, NOW(), NOW())
+                    ON CONFLICT (url) DO UPDATE SET source_hash = EXCLUDED.source_hash, title = EXCLUDED.title, body = EXCLUDED.body,
+                        cover_url = EXCLUDED.cover_url, translated_at = NOW(), checked_at = NOW()
+                """, url, source_hash, title, body, cover_url)
+
+    async def touch_guide_translation(self, url: str):
+        pool = await self.connect()
+        if pool:
+            async with pool.acquire() as conn:
+                await conn.execute("UPDATE guide_translations SET checked_at = NOW() WHERE url = $1", url)
 
     async def get_all_guide_channels(self):
         pool = await self.connect()
@@ -116,50 +264,84 @@ class Database:
             return [(r['guild_id'], r['guides_channel']) for r in rows]
 
     # --- МЕТОДЫ РЕПУТАЦИИ ---
-    async def can_give_rep(self, user_id: int):
+    REP_COOLDOWN = 86400
+
+    async def give_reputation(self, sender_id: int, target_id: int):
+        """Одна инструкция: обновляет кулдаун, только если прошло 24 часа, и лишь тогда начисляет репутацию.
+        Возвращает (новая репутация или None, сколько секунд осталось до следующей выдачи)"""
         pool = await self.connect()
-        if not pool: return False, 0
+        if not pool: return None, 0
         async with pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT EXTRACT(EPOCH FROM (NOW() AT TIME ZONE 'UTC' - last_rep)) AS diff FROM rep_cooldowns WHERE user_id = $1", user_id)
-            if not row: return True, 0
-            diff = row['diff']
-            if diff >= 86400: return True, 0
-            else: return False, int(86400 - diff)
+            row = await conn.fetchrow("""
+                WITH cd AS (
+                    INSERT INTO rep_cooldowns (user_id, last_rep) VALUES ($1, NOW() AT TIME ZONE 'UTC')
+                    ON CONFLICT (user_id) DO UPDATE SET last_rep = EXCLUDED.last_rep
+                    WHERE rep_cooldowns.last_rep <= (NOW() AT TIME ZONE 'UTC') - INTERVAL '24 hours'
+                    RETURNING user_id
+                ), up AS (
+                    INSERT INTO users (user_id, reputation) SELECT $2, 1 FROM cd
+                    ON CONFLICT (user_id) DO UPDATE SET reputation = users.reputation + 1
+                    RETURNING reputation
+                )
+                SELECT (SELECT reputation FROM up) AS reputation,
+                       (SELECT EXTRACT(EPOCH FROM (NOW() AT TIME ZONE 'UTC' - last_rep))::float FROM rep_cooldowns WHERE user_id = $1) AS diff
+            """, sender_id, target_id)
+        if row['reputation'] is not None: return row['reputation'], self.REP_COOLDOWN
+        # diff из снимка до конкурирующей выдачи может оказаться больше суток — тогда кулдаун только что начался
+        diff = row['diff'] or 0
+        return None, int(self.REP_COOLDOWN - diff) if diff < self.REP_COOLDOWN else self.REP_COOLDOWN
+
+    async def get_rep_cooldowns(self):
+        """Кулдауны репутации, которые ещё не истекли: {user_id: unix-время последней выдачи}"""
+        pool = await self.connect()
+        if not pool: return {}
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT user_id, EXTRACT(EPOCH FROM last_rep)::float AS ts FROM rep_cooldowns
+                WHERE last_rep > (NOW() AT TIME ZONE 'UTC') - INTERVAL '24 hours'
+            """)
+            return {r['user_id']: r['ts'] for r in rows}
 
-    async def add_reputation(self, sender_id: int, target_id: int):
+    # --- МЕТОДЫ ПОЛЬЗОВАТЕЛЕЙ И СТАТИСТИКИ ---
+    # --- ЖУРНАЛ ГОЛОСОВЫХ СЕССИЙ ---
+    async def start_voice_sessions(self, keys: List[tuple]):
         pool = await self.connect()
-        if pool:
+        if pool and keys:
             async with pool.acquire() as conn:
-                await conn.execute("INSERT INTO rep_cooldowns (user_id, last_rep) VALUES ($1, NOW() AT TIME ZONE 'UTC') ON CONFLICT (user_id) DO UPDATE SET last_rep = NOW() AT TIME ZONE 'UTC'", sender_id)
-                await conn.execute("INSERT INTO users (user_id, reputation) VALUES ($1, 1) ON CONFLICT (user_id) DO UPDATE SET reputation = COALESCE(users.reputation, 0) + 1", target_id)
-                return await conn.fetchval("SELECT reputation FROM users WHERE user_id = $1", target_id)
-        return 0
+                await conn.execute("""
+                    INSERT INTO voice_sessions (guild_id, user_id) SELECT * FROM unnest($1::bigint[], $2::bigint[])
+                    ON CONFLICT (guild_id, user_id) DO UPDATE SET started_at = NOW()
+                """, [g for g, _ in keys], [u for _, u in keys])
 
-    async def get_reputation(self, user_id: int):
-        pool = await self.connect()
-        if not pool: return 0
-        async with pool.acquire() as conn: return await conn.fetchval("SELECT reputation FROM users WHERE user_id = $1", user_id) or 0
+    VOICE_SESSIONS_END = """
+        DELETE FROM voice_sessions v USING unnest($1::bigint[], $2::bigint[]) AS d(guild_id, user_id)
+        WHERE v.guild_id = d.guild_id AND v.user_id = d.user_id
+    """
 
-    # --- МЕТОДЫ ПОЛЬЗОВАТЕЛЕЙ И СТАТИСТИКИ ---
-    async def add_message(self, user_id: int):
+    async def end_voice_sessions(self, keys: List[tuple]):
         pool = await self.connect()
-        if pool:
+        if pool and keys:
             async with pool.acquire() as conn:
-                await conn.execute("INSERT INTO users (user_id, messages) VALUES ($1, 1) ON CONFLICT (user_id) DO UPDATE SET messages = users.messages + 1", user_id)
+                await conn.execute(self.VOICE_SESSIONS_END, [g for g, _ in keys], [u for _, u in keys])
 
-    async def add_voice_time(self, user_id: int, minutes: int):
+    async def advance_voice_sessions(self, keys: List[tuple], elapsed: List[float]):
+        """Сдвигает начало сессий на момент последнего начисления (остаток в секундах)"""
         pool = await self.connect()
-        if pool:
+        if pool and keys:
             async with pool.acquire() as conn:
-                await conn.execute("INSERT INTO users (user_id, voice_minutes) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET voice_minutes = users.voice_minutes + $2", user_id, minutes)
+                await conn.execute("""
+                    UPDATE voice_sessions v SET started_at = NOW() - make_interval(secs => d.elapsed)
+                    FROM unnest($1::bigint[], $2::bigint[], $3::float8[]) AS d(guild_id, user_id, elapsed)
+                    WHERE v.guild_id = d.guild_id AND v.user_id = d.user_id
+                """, [g for g, _ in keys], [u for _, u in keys], elapsed)
 
-    async def get_user_stats(self, user_id: int):
+    async def get_voice_sessions(self):
+        """Журнал сессий: ключ (guild_id, user_id) -> сколько секунд прошло с последнего начисления"""
         pool = await self.connect()
-        if not pool: return {'messages': 0, 'voice_minutes': 0, 'voice_hours': 0, 'voice_remaining_minutes': 0}
+        if not pool: return {}
         async with pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT messages, voice_minutes FROM users WHERE user_id = $1", user_id)
-            if row: return {'messages': row['messages'], 'voice_minutes': row['voice_minutes'], 'voice_hours': row['voice_minutes'] // 60, 'voice_remaining_minutes': row['voice_minutes'] % 60}
-            return {'messages': 0, 'voice_minutes': 0, 'voice_hours': 0, 'voice_remaining_minutes': 0}
+            rows = await conn.fetch("SELECT guild_id, user_id, EXTRACT(EPOCH FROM NOW() - started_at)::float8 AS elapsed FROM voice_sessions")
+            return {(r['guild_id'], r['user_id']): r['elapsed'] for r in rows}
 
     async def get_top_users(self, limit: int = 10):
         pool = await self.connect()
@@ -182,95 +364,318 @@ class Database:
             return {'total_messages': row['total_messages'], 'total_voice': row['total_voice']}
 
     # --- МЕТОДЫ УРОВНЕЙ И ЭКОНОМИКИ ---
-    async def add_xp(self, user_id: int, xp: int):
+    # Пачечное начисление опыта: возвращает старый и новый уровень каждого пользователя
+    LEVELS_UPSERT = """
+        WITH d AS (SELECT * FROM unnest($1::bigint[], $2::int[]) AS d(user_id, xp)),
+        up AS (
+            INSERT INTO levels (user_id, xp, level) SELECT user_id, xp, level_for_xp(xp) FROM d
+            ON CONFLICT (user_id) DO UPDATE SET xp = levels.xp + EXCLUDED.xp, level = level_for_xp(levels.xp + EXCLUDED.xp), last_xp_time = NOW()
+            RETURNING user_id, xp, level
+        )
+        SELECT up.user_id, CASE WHEN up.xp = d.xp THEN 0 ELSE level_for_xp(up.xp - d.xp) END AS old_level, up.level AS new_level FROM up JOIN d USING (user_id)
+    """
+
+    async def apply_activity_batch(self, user_ids: List[int], messages: List[int], voice: List[int], coins: List[int], xp: List[int], reason: str = 'activity', end_sessions: List[tuple] = None):
+        """Применяет накопленные дельты активности пачкой: по одному запросу на users, coin_pending и levels.
+        Монеты копятся в coin_pending и попадают в economy и журнал при fold_coins.
+        end_sessions — голосовые сессии, которые закрываются в журнале той же транзакцией, что и начисление за них"""
         pool = await self.connect()
-        if not pool: return False, 0
+        if not pool: return {}
+        # Строки блокируются в порядке user_id: тик голоса и сброс сообщений пересекаются по пользователям и иначе могут взаимно заблокироваться
+        order = sorted(range(len(user_ids)), key=user_ids.__getitem__)
+        user_ids, messages, voice, coins, xp = ([column[i] for i in order] for column in (user_ids, messages, voice, coins, xp))
         async with pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT xp, level FROM levels WHERE user_id = $1", user_id)
-            new_xp, old_level = (row['xp'] + xp, row['level']) if row else (xp, 0)
-            if not row: await conn.execute("INSERT INTO levels (user_id, xp, level) VALUES ($1, 0, 0)", user_id)
-            new_level = int((math.sqrt(100 * (2 * new_xp + 25)) + 50) // 100)
-            await conn.execute("UPDATE levels SET xp = $1, level = $2, last_xp_time = NOW() WHERE user_id = $3", new_xp, new_level, user_id)
-            return new_level > old_level, new_level
+            async with conn.transaction():
+                msg_rows = await conn.fetch("""
+                    INSERT INTO users (user_id, messages, voice_minutes) SELECT * FROM unnest($1::bigint[], $2::int[], $3::int[])
+                    ON CONFLICT (user_id) DO UPDATE SET messages = users.messages + EXCLUDED.messages, voice_minutes = users.voice_minutes + EXCLUDED.voice_minutes
+                    RETURNING user_id, messages, voice_minutes
+                """, user_ids, messages, voice)
+                await conn.execute("""
+                    INSERT INTO coin_pending (user_id, reason, amount) SELECT u, $3, c FROM unnest($1::bigint[], $2::bigint[]) AS t(u, c) WHERE c <> 0
+                    ON CONFLICT (user_id, reason) DO UPDATE SET amount = coin_pending.amount + EXCLUDED.amount
+                """, user_ids, coins, reason)
+                xp_rows = await conn.fetch(self.LEVELS_UPSERT, user_ids, xp)
+                if end_sessions:
+                    await conn.execute(self.VOICE_SESSIONS_END, [g for g, _ in end_sessions], [u for _, u in end_sessions])
+        totals = {r['user_id']: {'messages': r['messages'], 'voice_minutes': r['voice_minutes']} for r in msg_rows}
+        for r in xp_rows: totals.setdefault(r['user_id'], {}).update(old_level=r['old_level'], new_level=r['new_level'])
+        return totals
+
+    @staticmethod
+    def _level_info(xp: int, level: int):
+        next_xp = int(((level + 1) * 100 - 50) ** 2 / 100)
+        return {'xp': xp, 'level': level, 'next_xp': next_xp, 'progress': xp/next_xp if next_xp > 0 else 0, 'remaining': next_xp - xp}
+
+    @staticmethod
+    def _user_stats(messages: int, voice_minutes: int):
+        return {'messages': messages, 'voice_minutes': voice_minutes, 'voice_hours': voice_minutes // 60, 'voice_remaining_minutes': voice_minutes % 60}
 
     async def get_level_info(self, user_id: int):
         pool = await self.connect()
-        if not pool: return {'xp': 0, 'level': 0, 'next_xp': 25, 'progress': 0, 'remaining': 25}
+        if not pool: return self._level_info(0, 0)
         async with pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT xp, level FROM levels WHERE user_id = $1", user_id)
-            xp, level = (row['xp'], row['level']) if row else (0, 0)
-            next_xp = int(((level + 1) * 100 - 50) ** 2 / 100)
-            return {'xp': xp, 'level': level, 'next_xp': next_xp, 'progress': xp/next_xp if next_xp > 0 else 0, 'remaining': next_xp - xp}
-
-    async def get_balance(self, user_id: int):
-        pool = await self.connect()
-        if not pool: return 0
-        async with pool.acquire() as conn: return await conn.fetchval("SELECT balance FROM economy WHERE user_id = $1", user_id) or 0
+            row = await conn.fetchrow("SELECT xp, level_for_xp(xp) AS level FROM levels WHERE user_id = $1", user_id)
+            return self._level_info(*((row['xp'], row['level']) if row else (0, 0)))
 
-    async def add_coins(self, user_id: int, amount: int):
+    async def get_profile_snapshot(self, user_id: int):
+        """Всё для профиля одним запросом: уровень, баланс, статистика, репутация, 3 последних достижения и ID темы"""
         pool = await self.connect()
+        row = None
         if pool:
             async with pool.acquire() as conn:
-                await conn.execute("INSERT INTO economy (user_id, balance, total_earned) VALUES ($1, $2, $2) ON CONFLICT (user_id) DO UPDATE SET balance = economy.balance + $2, total_earned = economy.total_earned + $2", user_id, amount)
+                row = await conn.fetchrow("""
+                    SELECT COALESCE(u.messages, 0) AS messages, COALESCE(u.voice_minutes, 0) AS voice_minutes, COALESCE(u.reputation, 0) AS reputation,
+                           COALESCE(l.xp, 0) AS xp, CASE WHEN l.user_id IS NULL THEN 0 ELSE level_for_xp(l.xp) END AS level,
+                           COALESCE(e.balance, 0) + COALESCE(p.pending, 0) AS balance,
+                           COALESCE(up.theme_id, 1) AS theme_id, ach.icons, ach.descriptions
+                    FROM (SELECT $1::bigint AS user_id) k
+                    LEFT JOIN users u ON u.user_id = k.user_id
+                    LEFT JOIN levels l ON l.user_id = k.user_id
+                    LEFT JOIN economy e ON e.user_id = k.user_id
+                    LEFT JOIN user_profile up ON up.user_id = k.user_id
+                    LEFT JOIN LATERAL (SELECT SUM(amount)::bigint AS pending FROM coin_pending cp WHERE cp.user_id = k.user_id) p ON TRUE
+                    LEFT JOIN LATERAL (
+                        SELECT array_agg(a.icon ORDER BY ua.earned_at DESC) AS icons, array_agg(a.description ORDER BY ua.earned_at DESC) AS descriptions
+                        FROM (SELECT achievement_id, earned_at FROM user_achievements WHERE user_id = k.user_id ORDER BY earned_at DESC LIMIT 3) ua
+                        JOIN achievements a ON a.id = ua.achievement_id
+                    ) ach ON TRUE
+                """, user_id)
+        if not row:
+            return {'level_info': self._level_info(0, 0), 'balance': 0, 'stats': self._user_stats(0, 0), 'reputation': 0, 'achievements': [], 'theme_id': 1}
+        return {
+            'level_info': self._level_info(row['xp'], row['level']),
+            'balance': row['balance'],
+            'stats': self._user_stats(row['messages'], row['voice_minutes']),
+            'reputation': row['reputation'],
+            'achievements': [{'icon': i, 'description': d} for i, d in zip(row['icons'] or [], row['descriptions'] or [])],
+            'theme_id': row['theme_id'],
+        }
 
-    async def remove_coins(self, user_id: int, amount: int):
+    # --- ЖУРНАЛ МОНЕТ ---
+    # Инвариант: economy.balance = SUM(coin_ledger.amount) по пользователю. Пассивный доход сначала копится
+    # в coin_pending (одна строка на пользователя и источник) и переносится в журнал и баланс в fold_coins.
+    COINS_APPLY = """
+        WITH t AS (SELECT u, c FROM unnest($1::bigint[], $2::bigint[]) AS t(u, c) WHERE c <> 0),
+        credit AS (
+            INSERT INTO economy (user_id, balance, total_earned) SELECT u, c, c FROM t WHERE c > 0
+            ON CONFLICT (user_id) DO UPDATE SET balance = economy.balance + EXCLUDED.balance, total_earned = economy.total_earned + EXCLUDED.total_earned
+            RETURNING user_id
+        ),
+        debit AS (
+            UPDATE economy e SET balance = e.balance + t.c FROM t
+            WHERE t.c < 0 AND e.user_id = t.u AND e.balance + t.c >= 0
+            RETURNING e.user_id
+        )
+        INSERT INTO coin_ledger (user_id, amount, reason, ref)
+        SELECT u, c, $3, $4 FROM t WHERE u IN (SELECT user_id FROM credit UNION ALL SELECT user_id FROM debit)
+        RETURNING user_id
+    """
+
+    COINS_FOLD = """
+        WITH moved AS (DELETE FROM coin_pending WHERE $1::bigint[] IS NULL OR user_id = ANY($1) RETURNING user_id, reason, amount),
+        logged AS (INSERT INTO coin_ledger (user_id, amount, reason) SELECT user_id, amount, reason FROM moved WHERE amount <> 0),
+        agg AS (SELECT user_id, SUM(amount) AS total, SUM(GREATEST(amount, 0)) AS earned FROM moved GROUP BY user_id)
+        INSERT INTO economy (user_id, balance, total_earned) SELECT user_id, total, earned FROM agg
+        ON CONFLICT (user_id) DO UPDATE SET balance = economy.balance + EXCLUDED.balance, total_earned = economy.total_earned + EXCLUDED.total_earned
+    """
+
+    async def fold_coins(self, user_ids: List[int] = None):
+        """Переносит накопленный пассивный доход в журнал и economy.balance одной инструкцией"""
         pool = await self.connect()
         if pool:
-            async with pool.acquire() as conn: await conn.execute("UPDATE economy SET balance = balance - $1 WHERE user_id = $2 AND balance >= $1", amount, user_id)
+            async with pool.acquire() as conn:
+                await conn.execute(self.COINS_FOLD, user_ids)
 
-    async def get_eco_top(self, limit: int = 10):
+    async def get_coin_audit(self, user_id: int, limit: int = 10):
         pool = await self.connect()
-        if not pool: return []
-        async with pool.acquire() as conn: return [(r['user_id'], r['balance']) for r in await conn.fetch("SELECT user_id, balance FROM economy ORDER BY balance DESC LIMIT $1", limit)]
+        if not pool: return None
+        async with pool.acquire() as conn:
+            summary = await conn.fetchrow("""
+                SELECT COALESCE((SELECT balance FROM economy WHERE user_id = $1), 0) AS balance,
+                       COALESCE((SELECT SUM(amount) FROM coin_ledger WHERE user_id = $1), 0)::bigint AS ledger,
+                       COALESCE((SELECT SUM(amount) FROM coin_pending WHERE user_id = $1), 0)::bigint AS pending
+            """, user_id)
+            entries = await conn.fetch("SELECT amount, reason, ref, created_at FROM coin_ledger WHERE user_id = $1 ORDER BY id DESC LIMIT $2", user_id, limit)
+            return {**dict(summary), 'entries': [dict(r) for r in entries]}
+
+    async def reconcile_coins(self):
+        """Сверяет балансы с журналом и записывает корректировки там, где они разошлись. Возвращает (пользователей, сумма расхождений)"""
+        pool = await self.connect()
+        if not pool: return 0, 0
+        async with pool.acquire() as conn:
+            await conn.execute(self.COINS_FOLD, None)
+            rows = await conn.fetch("""
+                WITH s AS (SELECT user_id, SUM(amount) AS total FROM coin_ledger GROUP BY user_id),
+                diff AS (
+                    SELECT user_id, COALESCE(e.balance, 0) - COALESCE(s.total, 0) AS drift
+                    FROM economy e FULL JOIN s USING (user_id)
+                    WHERE COALESCE(e.balance, 0) <> COALESCE(s.total, 0)
+                )
+                INSERT INTO coin_ledger (user_id, amount, reason) SELECT user_id, drift, 'reconcile' FROM diff
+                RETURNING amount
+            """)
+            return len(rows), sum(abs(r['amount']) for r in rows)
 
-    async def get_level_top(self, limit: int = 10):
+    async def buy_shop_role(self, guild_id: int, user_id: int, role_id: int):
+        """Списание, запись в журнал и выдача роли одной транзакцией. Цена читается из shop_roles в том же запросе.
+        Возвращает (успех, сообщение, актуальная цена или None, если роль больше не продаётся)"""
+        pool = await self.connect()
+        if not pool: return False, "❌ База данных недоступна.", None
+        async with pool.acquire() as conn:
+            try:
+                async with conn.transaction():
+                    await conn.execute(self.COINS_FOLD, [user_id])
+                    row = await conn.fetchrow("""
+                        WITH item AS (SELECT price FROM shop_roles WHERE guild_id = $1 AND role_id = $3 ORDER BY price LIMIT 1),
+                        debit AS (
+                            UPDATE economy SET balance = balance - item.price FROM item WHERE user_id = $2 AND balance >= item.price
+                              AND NOT EXISTS (SELECT 1 FROM purchased_roles WHERE guild_id = $1 AND user_id = $2 AND role_id = $3)
+                            RETURNING item.price
+                        ),
+                        bought AS (INSERT INTO purchased_roles (guild_id, user_id, role_id) SELECT $1, $2, $3 FROM debit),
+                        logged AS (INSERT INTO coin_ledger (user_id, amount, reason, ref) SELECT $2, -price, 'role_purchase', $4 FROM debit)
+                        SELECT (SELECT price FROM item) AS price, EXISTS (SELECT 1 FROM debit) AS paid,
+                               EXISTS (SELECT 1 FROM purchased_roles WHERE guild_id = $1 AND user_id = $2 AND role_id = $3) AS owned
+                    """, guild_id, user_id, role_id, f"guild:{guild_id}:role:{role_id}")
+            except asyncpg.UniqueViolationError:
+                return False, "❌ Роль уже куплена.", None
+        if row['price'] is None: return False, "❌ Роль не продается.", None
+        if row['owned']: return False, "❌ Роль уже куплена.", row['price']
+        if not row['paid']: return False, "❌ Недостаточно монет!", row['price']
+        return True, None, row['price']
+
+    async def refund_shop_role(self, guild_id: int, user_id: int, role_id: int, amount: int):
+        """Отмена покупки, если роль не удалось выдать: удаляет запись о покупке и возвращает монеты с записью в журнал"""
+        pool = await self.connect()
+        if not pool: return False
+        async with pool.acquire() as conn:
+            return bool(await conn.fetchval("""
+                WITH removed AS (DELETE FROM purchased_roles WHERE guild_id = $1 AND user_id = $2 AND role_id = $3 RETURNING user_id),
+                credit AS (UPDATE economy SET balance = balance + $4 WHERE user_id IN (SELECT user_id FROM removed) RETURNING user_id),
+                logged AS (INSERT INTO coin_ledger (user_id, amount, reason, ref) SELECT user_id, $4, 'refund', $5 FROM credit RETURNING 1)
+                SELECT EXISTS (SELECT 1 FROM logged)
+            """, guild_id, user_id, role_id, amount, f"guild:{guild_id}:role:{role_id}"))
+
+    # --- ЛИДЕРБОРДЫ ---
+    # Доска economy читает только economy.balance: пассивный доход из coin_pending попадает в неё после fold_coins (до 5 минут)
+    LEADERBOARDS = {
+        'voice': ("users", ("voice_minutes",)),
+        'messages': ("users", ("messages",)),
+        'economy': ("economy", ("balance",)),
+        'levels': ("levels", ("level", "xp")),
+        'reputation': ("users", ("reputation",)),
+    }
+
+    async def get_leaderboard(self, board: str, limit: int = 10):
+        """Топ по доске: ORDER BY по индексированным колонкам"""
+        table, cols = self.LEADERBOARDS[board]
         pool = await self.connect()
         if not pool: return []
-        async with pool.acquire() as conn: return [(r['user_id'], r['level'], r['xp']) for r in await conn.fetch("SELECT user_id, level, xp FROM levels ORDER BY level DESC, xp DESC LIMIT $1", limit)]
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(f"SELECT user_id, {', '.join(cols)} FROM {table} ORDER BY {', '.join(c + ' DESC' for c in cols)} LIMIT $1", limit)
+            return [tuple(r.values()) for r in rows]
 
-    # --- ИСТОРИЯ, НАСТРОЙКИ, МАГАЗИН И ПРЕДУПРЕЖДЕНИЯ ---
-    async def save_daily_stats(self, user_id: int, guild_id: int, voice_minutes: int, messages: int):
+    async def get_rank(self, board: str, user_id: int):
+        """Место пользователя: COUNT строк выше него по индексу. Стоимость растёт с местом (для последних — почти вся таблица),
+        поэтому вызывается через Leaderboards.rank, который кэширует результат на тот же TTL, что и топ"""
+        table, cols = self.LEADERBOARDS[board]
         pool = await self.connect()
-        if pool:
-            async with pool.acquire() as conn: await conn.execute("INSERT INTO user_history (user_id, guild_id, date, voice_minutes, messages) VALUES ($1, $2, CURRENT_DATE, $3, $4) ON CONFLICT (user_id, guild_id, date) DO UPDATE SET voice_minutes = EXCLUDED.voice_minutes, messages = EXCLUDED.messages", user_id, guild_id, voice_minutes, messages)
+        if not pool: return None
+        async with pool.acquire() as conn:
+            return await conn.fetchval(f"""
+                SELECT (SELECT COUNT(*) FROM {table} WHERE ({', '.join(cols)}) > ({', '.join('s.' + c for c in cols)})) + 1
+                FROM {table} s WHERE s.user_id = $1
+            """, user_id)
 
+    # --- ИСТОРИЯ, НАСТРОЙКИ, МАГАЗИН И ПРЕДУПРЕЖДЕНИЯ ---
     async def get_user_history(self, user_id: int, guild_id: int, days: int = 30):
         pool = await self.connect()
         if not pool: return []
         async with pool.acquire() as conn: return [dict(r) for r in await conn.fetch("SELECT date, voice_minutes, messages FROM user_history WHERE user_id = $1 AND guild_id = $2 ORDER BY date DESC LIMIT $3", user_id, guild_id, days)]
 
-    async def save_server_stats(self, guild_id: int, date: datetime.date = None):
+    async def save_guild_snapshot(self, guild_id: int, member_ids: List[int], new_members: int, date: datetime.date = None):
+        """Ночной снимок гильдии: user_history и server_history двумя INSERT ... SELECT по массиву участников"""
         date = date or datetime.date.today()
         pool = await self.connect()
         if not pool: return
         async with pool.acquire() as conn:
-            guild = bot.get_guild(guild_id)
-            if not guild: return
-            tm, tv, au, nm = 0, 0, 0, sum(1 for m in guild.members if m.joined_at and m.joined_at.date() == date)
-            for m in guild.members:
-                if m.bot: continue
-                s = await self.get_user_stats(m.id)
-                tm += s['messages']; tv += s['voice_minutes']
-                if s['messages'] > 0 or s['voice_minutes'] > 0: au += 1
-            await conn.execute("INSERT INTO server_history (guild_id, date, total_messages, total_voice_minutes, active_users, new_members) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (guild_id, date) DO UPDATE SET total_messages = EXCLUDED.total_messages, total_voice_minutes = EXCLUDED.total_voice_minutes, active_users = EXCLUDED.active_users, new_members = EXCLUDED.new_members", guild_id, date, tm, tv, au, nm)
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO user_history (user_id, guild_id, date, voice_minutes, messages)
+                    SELECT m.user_id, $2, $3, COALESCE(u.voice_minutes, 0), COALESCE(u.messages, 0)
+                    FROM unnest($1::bigint[]) AS m(user_id) LEFT JOIN users u USING (user_id)
+                    ON CONFLICT (user_id, guild_id, date) DO UPDATE SET voice_minutes = EXCLUDED.voice_minutes, messages = EXCLUDED.messages
+                """, member_ids, guild_id, date)
+                await conn.execute("""
+                    INSERT INTO server_history (guild_id, date, total_messages, total_voice_minutes, active_users, new_members)
+                    SELECT $2, $3, COALESCE(SUM(u.messages), 0), COALESCE(SUM(u.voice_minutes), 0), COUNT(*) FILTER (WHERE u.messages > 0 OR u.voice_minutes > 0), $4
+                    FROM unnest($1::bigint[]) AS m(user_id) JOIN users u USING (user_id)
+                    ON CONFLICT (guild_id, date) DO UPDATE SET total_messages = EXCLUDED.total_messages, total_voice_minutes = EXCLUDED.total_voice_minutes, active_users = EXCLUDED.active_users, new_members = EXCLUDED.new_members
+                """, member_ids, guild_id, date, new_members)
 
     async def get_server_stats(self, guild_id: int, days: int = 7):
         pool = await self.connect()
         if not pool: return []
         async with pool.acquire() as conn: return [dict(r) for r in await conn.fetch("SELECT * FROM server_history WHERE guild_id = $1 ORDER BY date DESC LIMIT $2", guild_id, days)]
 
+    @staticmethod
+    def default_guild_config(guild_id: int):
+        return {'guild_id': guild_id, 'log_channel': None, 'backup_channel': None, 'guides_channel': None, 'voice_events': True, 'role_events': True, 'member_events': True, 'channel_events': True, 'server_events': True, 'message_events': False, 'command_events': True, 'telegram_notify_role': False, 'telegram_daily_report': True, 'economy_enabled': True, 'achievements_enabled': True}
+
     async def get_guild_config(self, guild_id: int):
         pool = await self.connect()
-        default = {'guild_id': guild_id, 'log_channel': None, 'backup_channel': None, 'guides_channel': None, 'voice_events': True, 'role_events': True, 'member_events': True, 'channel_events': True, 'server_events': True, 'message_events': False, 'command_events': True, 'telegram_notify_role': False, 'telegram_daily_report': True, 'economy_enabled': True, 'achievements_enabled': True}
+        default = self.default_guild_config(guild_id)
         if not pool: return default
         async with pool.acquire() as conn:
             row = await conn.fetchrow("SELECT * FROM guild_config WHERE guild_id = $1", guild_id)
             return dict(row) if row else default
 
+    async def get_all_guild_configs(self):
+        pool = await self.connect()
+        if not pool: return {}
+        async with pool.acquire() as conn: return {r['guild_id']: dict(r) for r in await conn.fetch("SELECT * FROM guild_config")}
+
     async def update_guild_config(self, guild_id: int, key: str, value):
+        """Пишет настройку, перечитывает её в локальный кэш и оповещает другие процессы через NOTIFY"""
         pool = await self.connect()
         if pool:
-            async with pool.acquire() as conn: await conn.execute(f"INSERT INTO guild_config (guild_id, {key}) VALUES ($1, $2) ON CONFLICT (guild_id) DO UPDATE SET {key} = $2", guild_id, value)
+            async with pool.acquire() as conn:
+                await conn.execute(f"INSERT INTO guild_config (guild_id, {key}) VALUES ($1, $2) ON CONFLICT (guild_id) DO UPDATE SET {key} = $2", guild_id, value)
+                await conn.execute("SELECT pg_notify('guild_config', $1)", str(guild_id))
+        await refresh_guild_config(guild_id)
+
+    async def listen_guild_config(self):
+        """Отдельное соединение с LISTEN guild_config: изменения из других процессов перечитываются в кэш"""
+        if self.listener is not None and not self.listener.is_closed(): return
+        db_url = os.environ.get("DATABASE_URL")
+        if not db_url: return
+        try:
+            self.listener = await asyncpg.connect(db_url, ssl='require')
+            await self.listener.add_listener('guild_config', lambda conn, pid, channel, payload: self._spawn(refresh_guild_config(int(payload))))
+            self.listener.add_termination_listener(self._on_listener_lost)
+        except Exception as e:
+            print(f"⚠️ Не удалось подписаться на изменения настроек: {e}")
+            self.listener = None
+
+    def _spawn(self, coro):
+        """Задачи из колбэков asyncpg хранятся до завершения, иначе цикл событий может собрать их сборщиком мусора"""
+        task = asyncio.create_task(coro)
+        self.listener_tasks.add(task)
+        task.add_done_callback(self.listener_tasks.discard)
+
+    def _on_listener_lost(self, conn):
+        if conn is not self.listener: return  # штатное закрытие в ActivityBot.close: listener уже сброшен
+        self.listener = None
+        self._spawn(self._resubscribe())
+
+    async def _resubscribe(self):
+        """После обрыва LISTEN переподключается с паузами и перечитывает кэш целиком: уведомления за время обрыва потеряны"""
+        for attempt in range(5):
+            await asyncio.sleep(2 ** attempt)
+            await self.listen_guild_config()
+            if self.listener: break
+        await warm_guild_config_cache()
             
     async def set_log_channel(self, guild_id: int, channel_id: int):
         await self.update_guild_config(guild_id, 'log_channel', channel_id)
@@ -287,21 +692,13 @@ class Database:
         pool = await self.connect()
         if pool:
             async with pool.acquire() as conn: await conn.execute("INSERT INTO shop_roles (guild_id, role_id, price, description) VALUES ($1, $2, $3, $4)", guild_id, role_id, price, description or "Нет описания")
+            shop_catalog.invalidate(guild_id)
 
     async def remove_shop_role(self, role_id: int):
         pool = await self.connect()
         if pool:
-            async with pool.acquire() as conn: await conn.execute("DELETE FROM shop_roles WHERE role_id = $1", role_id)
-
-    async def purchase_role(self, guild_id: int, user_id: int, role_id: int):
-        pool = await self.connect()
-        if pool:
-            async with pool.acquire() as conn: await conn.execute("INSERT INTO purchased_roles (guild_id, user_id, role_id) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING", guild_id, user_id, role_id)
-
-    async def has_role_purchased(self, guild_id: int, user_id: int, role_id: int):
-        pool = await self.connect()
-        if not pool: return False
-        async with pool.acquire() as conn: return bool(await conn.fetchval("SELECT 1 FROM purchased_roles WHERE guild_id = $1 AND user_id = $2 AND role_id = $3", guild_id, user_id, role_id))
+            async with pool.acquire() as conn: guild_ids = await conn.fetch("DELETE FROM shop_roles WHERE role_id = $1 RETURNING guild_id", role_id)
+            for row in guild_ids: shop_catalog.invalidate(row['guild_id'])
 
     async def get_warns(self, guild_id: int, user_id: int):
         pool = await self.connect()
@@ -326,48 +723,68 @@ class Database:
     # --- ДОСТИЖЕНИЯ И ТЕМЫ ---
     async def init_achievements(self):
         achievements = [
-            ("chat_100", "Пиздaбoл", "Написать 100 сообщений", 50, 100, "💬"),
-            ("chat_1000", "Графоман", "Написать 1000 сообщений", 200, 500, "📝"),
-            ("voice_10h", "Микро...селебрити", "Провести 10 часов в голосе", 50, 100, "🎤"),
-            ("voice_100h", "Диктор", "Провести 100 часов в голосе", 200, 500, "📻"),
-            ("level_5", "Мдэ", "Достичь 5 уровня", 0, 0, "🌱"),
-            ("level_10", "Нормис", "Достичь 10 уровня", 0, 0, "🌿"),
-            ("level_20", "Бывалый", "Достичь 20 уровня", 0, 0, "⭐"),
-            ("first_warning", "Доигрался", "Получить первое предупреждение", 0, -50, "⚠️"),
-            ("first_purchase", "Шопоголик", "Купить первую роль", 20, 0, "🛒"),
+            # (название, заголовок, описание, опыт, монеты, иконка, метрика, порог)
+            ("chat_100", "Пиздaбoл", "Написать 100 сообщений", 50, 100, "💬", "messages", 100),
+            ("chat_1000", "Графоман", "Написать 1000 сообщений", 200, 500, "📝", "messages", 1000),
+            ("voice_10h", "Микро...селебрити", "Провести 10 часов в голосе", 50, 100, "🎤", "voice_minutes", 600),
+            ("voice_100h", "Диктор", "Провести 100 часов в голосе", 200, 500, "📻", "voice_minutes", 6000),
+            ("level_5", "Мдэ", "Достичь 5 уровня", 0, 0, "🌱", "level", 5),
+            ("level_10", "Нормис", "Достичь 10 уровня", 0, 0, "🌿", "level", 10),
+            ("level_20", "Бывалый", "Достичь 20 уровня", 0, 0, "⭐", "level", 20),
+            ("first_warning", "Доигрался", "Получить первое предупреждение", 0, -50, "⚠️", None, None),
+            ("first_purchase", "Шопоголик", "Купить первую роль", 20, 0, "🛒", None, None),
         ]
         pool = await self.connect()
         if not pool: return
         async with pool.acquire() as conn:
-            for name, title, desc, xp, coins, icon in achievements:
-                await conn.execute("""
-                    INSERT INTO achievements (name, description, xp_reward, coin_reward, icon)
-                    VALUES ($1, $2, $3, $4, $5) ON CONFLICT (name) DO UPDATE
-                    SET description = EXCLUDED.description, xp_reward = EXCLUDED.xp_reward, coin_reward = EXCLUDED.coin_reward, icon = EXCLUDED.icon
-                """, name, f"{title}: {desc}", xp, coins, icon)
-
-    async def check_achievement(self, user_id: int, achievement_name: str, guild: discord.Guild = None):
+            await conn.execute("""
+                INSERT INTO achievements (name, description, xp_reward, coin_reward, icon, metric, threshold)
+                SELECT * FROM unnest($1::text[], $2::text[], $3::int[], $4::bigint[], $5::text[], $6::text[], $7::int[])
+                ON CONFLICT (name) DO UPDATE
+                SET description = EXCLUDED.description, xp_reward = EXCLUDED.xp_reward, coin_reward = EXCLUDED.coin_reward, icon = EXCLUDED.icon,
+                    metric = EXCLUDED.metric, threshold = EXCLUDED.threshold
+            """, *map(list, zip(*[(name, f"{title}: {desc}", xp, coins, icon, metric, threshold) for name, title, desc, xp, coins, icon, metric, threshold in achievements])))
+
+    async def grant_achievements(self, user_ids: List[int], achievement_ids: List[int], no_coin_users: List[int] = None):
+        """Выдаёт достижения и награды за них одной транзакцией. Уже полученные пропускаются.
+        no_coin_users — пользователи из гильдий с выключенной экономикой: им начисляется только опыт.
+        Возвращает {user_id: {'achievements': [...], 'old_level', 'new_level'}} только для новых выдач"""
         pool = await self.connect()
-        if not pool: return False
+        if not pool or not user_ids: return {}
         async with pool.acquire() as conn:
-            ach = await conn.fetchrow("SELECT id, xp_reward, coin_reward, icon, description FROM achievements WHERE name = $1", achievement_name)
-            if not ach or await conn.fetchval("SELECT 1 FROM user_achievements WHERE user_id = $1 AND achievement_id = $2", user_id, ach['id']):
-                return False
-            await conn.execute("INSERT INTO user_achievements (user_id, achievement_id) VALUES ($1, $2)", user_id, ach['id'])
-            if ach['xp_reward'] > 0: await self.add_xp(user_id, ach['xp_reward'])
-            if ach['coin_reward'] > 0: await self.add_coins(user_id, ach['coin_reward'])
-            elif ach['coin_reward'] < 0: await self.remove_coins(user_id, -ach['coin_reward'])
-            
-            if guild:
-                config = await self.get_guild_config(guild.id)
-                if config.get('log_channel'):
-                    await Logger.log_event(guild, "achievement", "🏆 Получено достижение", f"{ach['icon']} **{ach['description']}**", 0xffd700, user=guild.get_member(user_id), fields={"Опыт": f"+{ach['xp_reward']}", "Монеты": f"+{ach['coin_reward']}"})
-            return True
-
-    async def get_user_achievements(self, user_id: int):
+            async with conn.transaction():
+                rows = await conn.fetch("""
+                    WITH ins AS (
+                        INSERT INTO user_achievements (user_id, achievement_id) SELECT * FROM unnest($1::bigint[], $2::int[])
+                        ON CONFLICT (user_id, achievement_id) DO NOTHING RETURNING user_id, achievement_id
+                    )
+                    SELECT ins.user_id, array_agg(a.id ORDER BY a.id) AS ids, SUM(a.xp_reward)::int AS xp,
+                           CASE WHEN ins.user_id = ANY($3::bigint[]) THEN 0 ELSE SUM(a.coin_reward) END::bigint AS coins
+                    FROM ins JOIN achievements a ON a.id = ins.achievement_id GROUP BY ins.user_id ORDER BY ins.user_id
+                """, user_ids, achievement_ids, no_coin_users or [])
+                if not rows: return {}
+                # Штрафы списываются, только если хватает баланса
+                await conn.execute(self.COINS_APPLY, [r['user_id'] for r in rows], [r['coins'] for r in rows], 'achievement', None)
+                xp_users = [r['user_id'] for r in rows if r['xp'] > 0]
+                xp_rows = await conn.fetch(self.LEVELS_UPSERT, xp_users, [r['xp'] for r in rows if r['xp'] > 0]) if xp_users else []
+        granted = {r['user_id']: {'achievements': list(r['ids'])} for r in rows}
+        for r in xp_rows: granted[r['user_id']].update(old_level=r['old_level'], new_level=r['new_level'])
+        return granted
+
+    async def get_achievement_backlog(self):
+        """Пары (user_id, achievement_id) для уже достигнутых, но не выданных пороговых достижений"""
         pool = await self.connect()
         if not pool: return []
-        async with pool.acquire() as conn: return [dict(r) for r in await conn.fetch("SELECT a.id, a.name, a.description, a.icon, ua.earned_at FROM user_achievements ua JOIN achievements a ON ua.achievement_id = a.id WHERE ua.user_id = $1 ORDER BY ua.earned_at DESC", user_id)]
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT u.user_id, a.id FROM achievements a JOIN users u
+                    ON (a.metric = 'messages' AND u.messages >= a.threshold) OR (a.metric = 'voice_minutes' AND u.voice_minutes >= a.threshold)
+                UNION
+                SELECT l.user_id, a.id FROM achievements a JOIN levels l ON a.metric = 'level' AND level_for_xp(l.xp) >= a.threshold
+                EXCEPT
+                SELECT user_id, achievement_id FROM user_achievements
+            """)
+            return [(r[0], r[1]) for r in rows]
 
     async def get_all_achievements(self):
         pool = await self.connect()
@@ -384,45 +801,18 @@ class Database:
         pool = await self.connect()
         if not pool: return
         async with pool.acquire() as conn:
-            for n, a, b, c, o, s, p, pr, pur in themes:
-                await conn.execute("INSERT INTO profile_themes (name, accent_color, bg_color, card_color, overlay_url, style, price, preview_url, purchasable) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) ON CONFLICT DO NOTHING", n, a, b, c, o, s, p, pr, pur)
-
-    async def get_user_profile(self, user_id: int):
-        pool = await self.connect()
-        if not pool: return {'user_id': user_id, 'theme_id': 1, 'custom_accent_color': None, 'custom_bg_color': None}
-        async with pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT * FROM user_profile WHERE user_id = $1", user_id)
-            if not row:
-                await conn.execute("INSERT INTO user_profile (user_id, theme_id) VALUES ($1, 1)", user_id)
-                return {'user_id': user_id, 'theme_id': 1, 'custom_accent_color': None, 'custom_bg_color': None}
-            return dict(row)
-
-    async def set_user_theme(self, user_id: int, theme_id: int):
-        pool = await self.connect()
-        if pool:
-            async with pool.acquire() as conn: await conn.execute("INSERT INTO user_profile (user_id, theme_id) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET theme_id = $2", user_id, theme_id)
-
-    async def get_theme_by_id(self, theme_id: int):
-        pool = await self.connect()
-        if not pool: return None
-        async with pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT * FROM profile_themes WHERE id = $1", theme_id)
-            return dict(row) if row else None
+            await conn.execute("""
+                INSERT INTO profile_themes (name, accent_color, bg_color, card_color, overlay_url, style, price, preview_url, purchasable)
+                SELECT n, a, b, c, o, s, p, pr, pur FROM unnest($1::text[], $2::int[], $3::int[], $4::int[], $5::text[], $6::text[], $7::bigint[], $8::text[], $9::bool[])
+                    WITH ORDINALITY AS t(n, a, b, c, o, s, p, pr, pur, ord)
+                ORDER BY ord ON CONFLICT DO NOTHING
+            """, *map(list, zip(*themes)))
 
     async def get_all_themes(self):
         pool = await self.connect()
         if not pool: return []
         async with pool.acquire() as conn: return [dict(r) for r in await conn.fetch("SELECT * FROM profile_themes ORDER BY price")]
 
-    async def purchase_theme(self, user_id: int, theme_id: int):
-        theme = await self.get_theme_by_id(theme_id)
-        if not theme: return False, "Тема не найдена"
-        balance = await self.get_balance(user_id)
-        if balance < theme['price']: return False, f"Недостаточно монет! Нужно {theme['price']} 🪙"
-        await self.remove_coins(user_id, theme['price'])
-        await self.set_user_theme(user_id, theme_id)
-        return True, f"✅ Тема **{theme['name']}** куплена и применена!"
-
 db = Database()
 
 # ==================== КОНФИГУРАЦИЯ ====================
@@ -450,6 +840,14 @@ LEVEL_ROLES = {
     85: "Модератор по сиськам", 100: "Админ по ляжкам"
 }
 DEFAULT_ROLE_NAME = "Залётный"
+LEVEL_ROLE_THRESHOLDS = sorted(LEVEL_ROLES)
+LEVEL_ROLE_NAMES = frozenset(LEVEL_ROLES.values())
+MANAGED_ROLE_NAMES = LEVEL_ROLE_NAMES | {DEFAULT_ROLE_NAME}
+
+def role_name_for_level(level: int, default: str = None):
+    """Имя уровневой роли для уровня: бинарный поиск по отсортированным порогам"""
+    idx = bisect.bisect_right(LEVEL_ROLE_THRESHOLDS, level)
+    return LEVEL_ROLES[LEVEL_ROLE_THRESHOLDS[idx - 1]] if idx else default
 REP_REWARD_ROLE = "Ну крутой ля" 
 
 intents = discord.Intents.default()
@@ -459,45 +857,201 @@ intents.voice_states = True
 intents.messages = True
 intents.guilds = True
 
-voice_sessions = {}
+voice_sessions: Dict[Tuple[int, int], float] = {}
+voice_tick_stats = {'members': 0, 'level_ups': 0, 'duration_ms': 0.0}
 guild_config_cache = {}
 
+class RoleIndex:
+    """Индекс ролей гильдии по имени. Строится лениво, сбрасывается событиями on_guild_role_*"""
+    def __init__(self):
+        self.guilds: Dict[int, Dict[str, discord.Role]] = {}
+
+    def get(self, guild: discord.Guild, name: str):
+        index = self.guilds.get(guild.id)
+        if index is None:
+            index = self.guilds[guild.id] = {}
+            for role in guild.roles: index.setdefault(role.name, role)
+        return index.get(name)
+
+    def invalidate(self, guild_id: int):
+        self.guilds.pop(guild_id, None)
+
+role_index = RoleIndex()
+
+def normalize_name(name: str) -> str:
+    return ' '.join(name.casefold().split())
+
+class ShopCatalog:
+    """Каталоги магазина ролей по гильдиям и общий каталог тем в памяти.
+    Магазин сбрасывается при add/remove_shop_role, изменениях ролей и расхождении с shop_roles при покупке, темы загружаются один раз"""
+    def __init__(self):
+        self.guilds: Dict[int, dict] = {}
+        self.themes: Dict[int, dict] = {}
+
+    async def _guild(self, guild: discord.Guild) -> dict:
+        catalog = self.guilds.get(guild.id)
+        if catalog is None:
+            items = await db.get_shop_roles(guild.id)
+            by_name = {}
+            for item in items:
+                role = guild.get_role(item['role_id'])
+                if role: by_name.setdefault(normalize_name(role.name), item)
+            catalog = self.guilds[guild.id] = {'items': items, 'by_name': by_name}
+        return catalog
+
+    async def items(self, guild: discord.Guild) -> List[dict]:
+        return (await self._guild(guild))['items']
+
+    async def find(self, guild: discord.Guild, name: str):
+        return (await self._guild(guild))['by_name'].get(normalize_name(name))
+
+    def invalidate(self, guild_id: int = None):
+        if guild_id is None: self.guilds.clear()
+        else: self.guilds.pop(guild_id, None)
+
+    async def load_themes(self):
+        themes = await db.get_all_themes()
+        self.themes = {t['id']: t for t in themes}
+
+    async def theme(self, theme_id: int):
+        """Тема по ID; неизвестные ID получают тему по умолчанию (ID 1)"""
+        if not self.themes: await self.load_themes()
+        return self.themes.get(theme_id) or self.themes.get(1)
+
+shop_catalog = ShopCatalog()
+
+# ==================== HTTP-КЛИЕНТ ====================
+class HttpClient:
+    """Общий aiohttp-клиент бота: один пул соединений и TLS-сессии на весь процесс"""
+    def __init__(self):
+        self.session = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        return self.session
+
+    async def close(self):
+        if self.session and not self.session.closed: await self.session.close()
+        self.session = None
+
+http_client = HttpClient()
+
 # ==================== TELEGRAM БОТ ====================
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+
 class TelegramBot:
+    OUTBOX_SIZE = 200
+    SEND_INTERVAL = 1.0      # Telegram допускает около одного сообщения в секунду в один чат
+    COALESCE_WINDOW = 2.0    # уведомления, пришедшие за это время, склеиваются в одну сводку
+    MESSAGE_LIMIT = 4096
+    MAX_RETRIES = 3
+
     def __init__(self, token: str, chat_id: str):
         self.token = token
         self.chat_id = chat_id
-        self.base_url = f"https://api.telegram.org/bot{token}"
+        self.base_url = f"{TELEGRAM_API_URL}/bot{token}"
         self.enabled = bool(token and chat_id)
         self.session = None
         self.polling_task = None
+        self.outbox = asyncio.Queue(maxsize=self.OUTBOX_SIZE)
+        self.sender_task = None
+        self.stats = {'sent': 0, 'digests': 0, 'dropped': 0, 'retries': 0}
 
     async def ensure_session(self):
         if self.session is None and self.enabled:
             self.session = aiohttp.ClientSession()
 
+    @property
+    def queue_depth(self) -> int:
+        return self.outbox.qsize()
+
+    async def _post(self, method: str, form=None, **kwargs) -> bool:
+        """POST в Bot API; при 429 ждёт retry_after и повторяет. form — фабрика FormData, её нельзя отправить дважды"""
+        await self.ensure_session()
+        for _ in range(self.MAX_RETRIES):
+            if form: kwargs['data'] = form()
+            async with self.session.post(f"{self.base_url}/{method}", **kwargs) as resp:
+                if resp.status != 429:
+                    return resp.status == 200
+                try:
+                    retry_after = (await resp.json()).get("parameters", {}).get("retry_after", 1)
+                except Exception:
+                    retry_after = 1
+            self.stats['retries'] += 1
+            await asyncio.sleep(retry_after)
+        return False
+
     async def send_message(self, text: str) -> bool:
         if not self.enabled: return False
         try:
-            await self.ensure_session()
-            payload = {"chat_id": self.chat_id, "text": text, "parse_mode": "Markdown"}
-            async with self.session.post(f"{self.base_url}/sendMessage", json=payload) as resp:
-                return resp.status == 200
+            ok = await self._post("sendMessage", json={"chat_id": self.chat_id, "text": text, "parse_mode": "Markdown"})
+            if ok: self.stats['sent'] += 1
+            return ok
         except Exception as e:
             print(f"❌ Telegram send error: {e}")
             return False
 
-    async def send_document(self, file_path: str, caption: str = "") -> bool:
+    def enqueue(self, text: str, coalesce: bool = False) -> bool:
+        """Ставит сообщение в очередь отправки, не дожидаясь Telegram; при переполнении сообщение отбрасывается"""
         if not self.enabled: return False
+        if self.sender_task is None:
+            self.sender_task = asyncio.create_task(self._sender_loop())
         try:
-            await self.ensure_session()
-            with open(file_path, 'rb') as f:
-                data = aiohttp.FormData()
-                data.add_field('chat_id', self.chat_id)
-                data.add_field('caption', caption)
-                data.add_field('document', f, filename=os.path.basename(file_path))
-                async with self.session.post(f"{self.base_url}/sendDocument", data=data) as resp:
-                    return resp.status == 200
+            self.outbox.put_nowait((text, coalesce))
+            return True
+        except asyncio.QueueFull:
+            self.stats['dropped'] += 1
+            return False
+
+    def _build_digests(self, alerts: List[str]) -> List[str]:
+        if len(alerts) == 1: return alerts
+        digests, current = [], f"📬 *Сводка уведомлений ({len(alerts)})*"
+        for alert in alerts:
+            if len(current) + len(alert) + 2 > self.MESSAGE_LIMIT:
+                digests.append(current)
+                current = ""
+            current = f"{current}\n\n{alert}" if current else alert
+        digests.append(current)
+        return digests
+
+    async def _sender_loop(self):
+        last_sent = 0.0
+        while True:
+            try:
+                batch = [await self.outbox.get()]
+                try:
+                    if batch[0][1]:
+                        await asyncio.sleep(self.COALESCE_WINDOW)
+                    while not self.outbox.empty():
+                        batch.append(self.outbox.get_nowait())
+
+                    alerts = [text for text, coalesce in batch if coalesce]
+                    messages = [text for text, coalesce in batch if not coalesce]
+                    if len(alerts) > 1: self.stats['digests'] += 1
+                    for text in messages + (self._build_digests(alerts) if alerts else []):
+                        wait = last_sent + self.SEND_INTERVAL - time.monotonic()
+                        if wait > 0: await asyncio.sleep(wait)
+                        await self.send_message(text)
+                        last_sent = time.monotonic()
+                finally:
+                    for _ in batch:
+                        self.outbox.task_done()
+            except asyncio.CancelledError: break
+            except Exception as e:
+                print(f"❌ Telegram sender error: {e}")
+                await asyncio.sleep(5)
+
+    async def send_document(self, content: bytes, filename: str, caption: str = "") -> bool:
+        if not self.enabled: return False
+        def form():
+            data = aiohttp.FormData()
+            data.add_field('chat_id', self.chat_id)
+            data.add_field('caption', caption)
+            data.add_field('document', content, filename=filename, content_type='application/octet-stream')
+            return data
+        try:
+            return await self._post("sendDocument", form=form)
         except Exception as e:
             print(f"❌ Telegram send doc error: {e}")
             return False
@@ -514,7 +1068,7 @@ class TelegramBot:
 
     async def send_alert(self, title: str, description: str, alert_type: str = "info") -> bool:
         emoji = {"info": "ℹ️", "success": "✅", "warning": "⚠️", "error": "❌"}.get(alert_type, "📝")
-        return await self.send_message(f"{emoji} *{title}*\n\n{description}\n\n⏰ {format_moscow_time()}")
+        return self.enqueue(f"{emoji} *{title}*\n\n{description}\n\n⏰ {format_moscow_time()}", coalesce=True)
 
     async def start_polling(self):
         if not self.enabled: return
@@ -533,7 +1087,8 @@ class TelegramBot:
                         for update in data.get("result", []):
                             offset = update["update_id"]
                             await self._process_update(update)
-                await asyncio.sleep(1)
+                    else:
+                        await asyncio.sleep(5)
             except asyncio.CancelledError: break
             except Exception as e:
                 print(f"❌ Telegram polling error: {e}")
@@ -551,6 +1106,13 @@ class TelegramBot:
         if self.polling_task:
             self.polling_task.cancel()
             self.polling_task = None
+        if self.sender_task:
+            try:
+                await asyncio.wait_for(self.outbox.join(), timeout=10)
+            except asyncio.TimeoutError:
+                print(f"⚠️ Telegram: не отправлено сообщений из очереди: {self.queue_depth}")
+            self.sender_task.cancel()
+            self.sender_task = None
         if self.session: await self.session.close()
 
 telegram = TelegramBot(TELEGRAM_TOKEN, TELEGRAM_CHAT_ID)
@@ -631,138 +1193,263 @@ def split_text_for_discord(text: str, max_len: int = 1900):
         chunks.append(text)
     return chunks
 
-async def fetch_and_translate_guide(url: str):
-    if not ai_client:
-        return None, None, None
-        
-    try:
-        async with aiohttp.ClientSession() as session:
-            headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
-            async with session.get(url, headers=headers) as resp:
-                if resp.status != 200: return None, None, None
-                html = await resp.text()
-
-        soup = BeautifulSoup(html, 'lxml')
-        
-        # Получаем заголовок
-        title_meta = soup.find('meta', property='og:title')
-        en_title = title_meta['content'].replace(" | Game8", "") if title_meta else "Гайд Endfield"
-        
-        # Получаем главную обложку статьи (для карточки-анонса)
-        img_meta = soup.find('meta', property='og:image')
-        cover_url = img_meta['content'] if img_meta else None
-        
-        content = soup.find('div', class_='archive-style-wrapper')
-        if not content:
-            content = soup.find('article') or soup.body
-
-        # 1. УБИВАЕМ МУСОРНЫЕ ССЫЛКИ, СОХРАНЯЯ ТЕКСТ
-        for a_tag in content.find_all('a'):
-            a_tag.unwrap() # Снимает тег <a>, оставляя текст внутри него
-
-        # 2. УБИВАЕМ АБСОЛЮТНО ВСЕ КАРТИНКИ ИЗ ТЕЛА СТАТЬИ
-        for img in content.find_all('img'):
-            img.decompose()
-
-        # 3. Удаляем мусорные блоки Game8 (рекламу, оглавления, боковые панели)
-        for tag in content(['script', 'style', 'ins', 'iframe', 'nav', 'div.toc']):
-            tag.decompose()
-            
-        for tag in content.find_all('div', class_=['a-ad', 'a-ad__container', 'a-linkHeader', 'article-bottom-links']):
-            tag.decompose()
-
-        raw_text = str(content)
-
-        prompt = f"""
-        Ты — эксперт по игре Arknights: Endfield. Переведи гайд с сайта Game8 на русский язык.
-
-        ЗАГОЛОВОК СТАТЬИ: {en_title}
+GUIDE_SKIP_TAGS = {'script', 'style', 'ins', 'iframe', 'nav', 'img', 'noscript', 'svg', 'button', 'form'}
+GUIDE_SKIP_CLASSES = {'a-ad', 'a-ad__container', 'a-linkHeader', 'article-bottom-links', 'toc'}
+GUIDE_BLOCK_TAGS = {'p', 'div', 'section', 'ul', 'ol', 'table', 'tr', 'blockquote', 'dl', 'dt', 'dd'}
+GUIDE_HEADINGS = {'h1': '# ', 'h2': '## ', 'h3': '### ', 'h4': '### ', 'h5': '### ', 'h6': '### '}
+
+def _walk_guide(node, out: list):
+    """Один проход по поддереву статьи: пропускает мусор, ссылки и картинки превращает в текст"""
+    for child in node:
+        tag = child.tag if isinstance(child.tag, str) else None
+        if tag and tag not in GUIDE_SKIP_TAGS and not GUIDE_SKIP_CLASSES.intersection(child.get('class', '').split()):
+            if tag in GUIDE_HEADINGS: out.append('\n' + GUIDE_HEADINGS[tag])
+            elif tag == 'li': out.append('\n- ')
+            elif tag == 'br' or tag in GUIDE_BLOCK_TAGS: out.append('\n')
+            if child.text: out.append(child.text)
+            _walk_guide(child, out)
+            if tag in ('td', 'th'): out.append(' | ')
+            elif tag in GUIDE_HEADINGS or tag in GUIDE_BLOCK_TAGS: out.append('\n')
+        # Хвостовой текст принадлежит родителю, поэтому сохраняется даже у вырезанных тегов
+        if child.tail: out.append(child.tail)
+
+def _extract_guide_sync(html: str):
+    """Чистит HTML гайда: возвращает (заголовок, обложку, компактный текст для перевода)"""
+    import lxml.html
+    doc = lxml.html.fromstring(html.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+    title_meta = doc.xpath('//meta[@property="og:title"]/@content')
+    en_title = title_meta[0].replace(" | Game8", "") if title_meta else "Гайд Endfield"
+    img_meta = doc.xpath('//meta[@property="og:image"]/@content')
+    cover_url = img_meta[0] if img_meta else None
+
+    content = doc.xpath('//div[contains(concat(" ", normalize-space(@class), " "), " archive-style-wrapper ")]')
+    if not content:
+        content = doc.xpath('//article') or doc.xpath('//body') or [doc]
+
+    out = [content[0].text or '']
+    _walk_guide(content[0], out)
+    lines = (' '.join(line.split()) for line in ''.join(out).splitlines())
+    text = '\n'.join(line.removesuffix(' |') for line in lines if line and line != '|')
+    return en_title, cover_url, text[:40000]
+
+async def _translate_guide(ai_client, en_title: str, raw_text: str):
+    prompt = f"""
+    Ты — эксперт по игре Arknights: Endfield. Переведи гайд с сайта Game8 на русский язык.
+
+    ЗАГОЛОВОК СТАТЬИ: {en_title}
+
+    ПРАВИЛА ОФОРМЛЕНИЯ:
+    1. Переведи ВЕСЬ полезный текст статьи. Не делай кратких выжимок, сохраняй подробности!
+    2. Используй Markdown Discord для красивого оформления (жирный шрифт, заголовки, списки).
+    3. Строки таблиц даны через « | » — преврати их в аккуратные текстовые списки.
+    4. Используй правильный игровой сленг (АоЕ, Урон, Операторы, Кастер и т.д.).
+
+    ОТВЕТ ВЫДАЙ СТРОГО В ТАКОМ ФОРМАТЕ (с разделителем ===):
+    [Переведенный Заголовок]
+    ===
+    [Полный переведенный текст]
+
+    ТЕКСТ ДЛЯ ПЕРЕВОДА:
+    {raw_text}
+    """
+    
+    response = await asyncio.to_thread(
+        ai_client.models.generate_content,
+        model='gemini-2.5-flash',
+        contents=prompt
+    )
+    
+    parts = response.text.split('===')
+    if len(parts) == 2:
+        return parts[0].strip(), parts[1].strip()
+    return en_title, response.text.strip()
 
-        ПРАВИЛА ОФОРМЛЕНИЯ:
-        1. Переведи ВЕСЬ полезный текст статьи. Не делай кратких выжимок, сохраняй подробности!
-        2. Используй Markdown Discord для красивого оформления (жирный шрифт, заголовки, списки).
-        3. Если в тексте есть HTML-таблицы, преврати их в аккуратные текстовые списки.
-        4. Используй правильный игровой сленг (АоЕ, Урон, Операторы, Кастер и т.д.).
+# Сколько секунд перевод из кэша отдаётся без повторной загрузки страницы
+GUIDE_RECHECK_SECONDS = 6 * 3600
+guide_cache_stats = {'fresh': 0, 'unchanged': 0, 'translated': 0}
 
-        ОТВЕТ ВЫДАЙ СТРОГО В ТАКОМ ФОРМАТЕ (с разделителем ===):
-        [Переведенный Заголовок]
-        ===
-        [Полный переведенный текст]
+async def fetch_and_translate_guide(url: str):
+    """Перевод гайда с кэшем в БД: ИИ вызывается, только если очищенный текст страницы изменился"""
+    cached = await db.get_guide_translation(url)
+    if cached and cached['age'] < GUIDE_RECHECK_SECONDS:
+        guide_cache_stats['fresh'] += 1
+        return cached['title'], cached['body'], cached['cover_url']
 
-        ТЕКСТ ДЛЯ ПЕРЕВОДА:
-        {raw_text[:40000]}
-        """
-        
-        response = await asyncio.to_thread(
-            ai_client.models.generate_content,
-            model='gemini-2.5-flash',
-            contents=prompt
-        )
-        
-        parts = response.text.split('===')
-        if len(parts) == 2:
-            return parts[0].strip(), parts[1].strip(), cover_url
-        return en_title, response.text.strip(), cover_url
+    try:
+        session = await http_client.get_session()
+        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
+        async with session.get(url, headers=headers) as resp:
+            if resp.status != 200:
+                if cached: return cached['title'], cached['body'], cached['cover_url']
+                return None, None, None
+            html = await resp.text()
+
+        en_title, cover_url, raw_text = await asyncio.to_thread(_extract_guide_sync, html)
+        source_hash = hashlib.sha256(raw_text.encode('utf-8')).hexdigest()
+
+        if cached and cached['source_hash'] == source_hash:
+            guide_cache_stats['unchanged'] += 1
+            await db.touch_guide_translation(url)
+            return cached['title'], cached['body'], cached['cover_url']
+
+        ai_client = get_ai_client()
+        if not ai_client:
+            if cached: return cached['title'], cached['body'], cached['cover_url']
+            return None, None, None
+
+        ru_title, ru_body = await _translate_guide(ai_client, en_title, raw_text)
+        guide_cache_stats['translated'] += 1
+        await db.save_guide_translation(url, source_hash, ru_title, ru_body, cover_url)
+        return ru_title, ru_body, cover_url
         
     except Exception as e:
         print(f"Ошибка парсинга/перевода: {e}")
+        if cached: return cached['title'], cached['body'], cached['cover_url']
         return None, None, None
 
+# Лимиты Discord: описание embed — 4096 символов, в сообщении до 10 embed и не более 6000 символов суммарно
+GUIDE_EMBED_LIMIT = 4096
+GUIDE_MESSAGE_LIMIT = 6000
+GUIDE_FANOUT_CONCURRENCY = 8
+guide_publish_stats = {'guides': 0, 'guilds': 0, 'messages': 0, 'duration_ms': 0.0}
+
+def pack_guide_embeds(text: str) -> List[List[discord.Embed]]:
+    """Упаковывает текст гайда в сообщения из нескольких embed вместо множества коротких сообщений"""
+    # Куски по 3000 символов: два embed полностью заполняют лимит сообщения в 6000
+    messages, current, size = [], [], 0
+    for chunk in split_text_for_discord(text, max_len=min(GUIDE_EMBED_LIMIT, GUIDE_MESSAGE_LIMIT // 2)):
+        if current and (len(current) == 10 or size + len(chunk) > GUIDE_MESSAGE_LIMIT):
+            messages.append(current)
+            current, size = [], 0
+        current.append(discord.Embed(description=chunk, color=0x00A8FF))
+        size += len(chunk)
+    if current:
+        messages.append(current)
+    return messages
+
+async def send_guide_thread(msg: discord.Message, ru_title: str, pages: List[List[discord.Embed]]) -> int:
+    """Создаёт ветку под анонсом и отправляет в неё упакованный гайд; ожидание лимитов берёт на себя discord.py.
+    Возвращает число доставленных сообщений: при ошибке — сколько успело уйти до неё"""
+    sent = 0
+    try:
+        thread = await msg.create_thread(name=ru_title[:100], auto_archive_duration=1440)
+        for embeds in pages:
+            await thread.send(embeds=embeds)
+            sent += 1
+    except Exception as e:
+        print(f"Ошибка отправки ветки в Discord: {e}")
+    return sent
+
+async def publish_guide(url: str, ru_title: str, ru_body: str, cover_url: str):
+    """Публикует переведённый гайд во все настроенные каналы гайдов параллельно"""
+    channels = await db.get_all_guide_channels()
+    pages = pack_guide_embeds(ru_body)
+    semaphore = asyncio.Semaphore(GUIDE_FANOUT_CONCURRENCY)
+
+    async def publish_to(guild_id, channel_id):
+        guild = bot.get_guild(guild_id)
+        ch = guild.get_channel(channel_id) if guild else None
+        if not ch: return 0
+        async with semaphore:
+            try:
+                embed = discord.Embed(
+                    title=f"📚 Новый гайд: {ru_title}",
+                    url=url,
+                    description="⬇️ Полный переведенный гайд читайте в ветке ниже! ⬇️",
+                    color=0x00A8FF
+                )
+                if cover_url:
+                    embed.set_image(url=cover_url)
+                embed.set_footer(text="Game8 • Переведено ИИ", icon_url="https://game8.co/favicon.ico")
+                
+                msg = await ch.send(embed=embed)
+            except Exception as e:
+                print(f"Ошибка отправки анонса гайда в Discord: {e}")
+                return 0
+            return await send_guide_thread(msg, ru_title, pages) + 1
+
+    start = time.perf_counter()
+    sent = await asyncio.gather(*(publish_to(g, c) for g, c in channels))
+    duration_ms = (time.perf_counter() - start) * 1000
+    guilds = sum(1 for n in sent if n)
+    guide_publish_stats.update(guides=guide_publish_stats['guides'] + 1, guilds=guilds, messages=sum(sent), duration_ms=duration_ms)
+    print(f"📚 Гайд «{ru_title}» опубликован: серверов {guilds}, сообщений {sum(sent)}, за {duration_ms / 1000:.1f} с")
+
+GAME8_INDEX_URL = os.environ.get("GAME8_INDEX_URL", "https://game8.co/games/Arknights-Endfield")
+
+class Game8Crawler:
+    """Обход индекса Game8: условный GET, дедупликация одной пачкой и очередь гайдов в БД с ограниченным параллелизмом"""
+    CONCURRENCY = 2
+    PUBLISH_PER_CYCLE = 2   # Гайдов за один запуск: остальные ждут в очереди до следующих циклов
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, index_url: str):
+        self.index_url = index_url
+        self.archive_path = urlparse(index_url).path.rstrip('/') + '/archives/'
+
+    async def fetch_index(self, state: dict):
+        """Возвращает (html, etag, last_modified) или None, если страница не изменилась (304)"""
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        if state.get('etag'): headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'): headers['If-Modified-Since'] = state['last_modified']
+        session = await http_client.get_session()
+        async with session.get(self.index_url, headers=headers) as resp:
+            if resp.status != 200: return None
+            return await resp.text(), resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+
+    def extract_links(self, html: str) -> List[str]:
+        import lxml.html
+        doc = lxml.html.fromstring(html.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+        links = []
+        for href in doc.xpath('//a[contains(concat(" ", normalize-space(@class), " "), " a-link ")]/@href'):
+            full_url = urljoin(self.index_url, href)
+            if urlparse(full_url).path.startswith(self.archive_path) and full_url not in links:
+                links.append(full_url)
+        return links
+
+    async def discover(self) -> int:
+        state = await db.get_crawler_state(self.index_url)
+        fetched = await self.fetch_index(state)
+        if fetched is None: return 0
+        html, etag, last_modified = fetched
+        links = self.extract_links(html)
+        if not state:
+            # Первый обход: как и раньше, в работу идёт только самый свежий гайд, остальной архив считается опубликованным
+            await db.seed_posted_guides(links[1:])
+            links = links[:1]
+        queued = await db.enqueue_guides(links)
+        await db.save_crawler_state(self.index_url, etag, last_modified)
+        return len(queued)
+
+    async def process(self, url: str):
+        try:
+            ru_title, ru_body, cover_url = await fetch_and_translate_guide(url)
+            if not ru_title or not ru_body: raise RuntimeError("не удалось получить или перевести гайд")
+            await publish_guide(url, ru_title, ru_body, cover_url)
+            await db.complete_queued_guide(url)
+        except Exception as e:
+            print(f"Ошибка обработки гайда {url}: {e}")
+            await db.fail_queued_guide(url, str(e))
+
+    async def drain(self) -> int:
+        """Обрабатывает не больше PUBLISH_PER_CYCLE готовых гайдов из очереди в порядке индекса"""
+        urls = await db.get_queued_guides(self.PUBLISH_PER_CYCLE, self.MAX_ATTEMPTS)
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        async def worker(url):
+            async with semaphore: await self.process(url)
+
+        await asyncio.gather(*(worker(u) for u in urls))
+        return len(urls)
+
+game8_crawler = Game8Crawler(GAME8_INDEX_URL)
+
 @tasks.loop(minutes=30)
 async def auto_game8_parser():
-    url = "https://game8.co/games/Arknights-Endfield"
     try:
-        async with aiohttp.ClientSession() as session:
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            async with session.get(url, headers=headers) as resp:
-                if resp.status != 200: return
-                html = await resp.text()
-
-        soup = BeautifulSoup(html, 'lxml')
-        links = soup.select('a.a-link') 
-        
-        new_guides = []
-        for link in links:
-            href = link.get('href')
-            if href and "/games/Arknights-Endfield/archives/" in href:
-                full_url = "https://game8.co" + href if href.startswith('/') else href
-                if not await db.is_guide_posted(full_url):
-                    new_guides.append(full_url)
-                    
-        if new_guides:
-            target_url = new_guides[0]
-            ru_title, ru_body, cover_url = await fetch_and_translate_guide(target_url)
-            if not ru_title or not ru_body: return
-
-            channels = await db.get_all_guide_channels()
-            for guild_id, channel_id in channels:
-                guild = bot.get_guild(guild_id)
-                if guild:
-                    ch = guild.get_channel(channel_id)
-                    if ch:
-                        try:
-                            embed = discord.Embed(
-                                title=f"📚 Новый гайд: {ru_title}",
-                                url=target_url,
-                                description="⬇️ Полный переведенный гайд читайте в ветке ниже! ⬇️",
-                                color=0x00A8FF
-                            )
-                            if cover_url:
-                                embed.set_image(url=cover_url)
-                            embed.set_footer(text="Game8 • Переведено ИИ", icon_url="https://game8.co/favicon.ico")
-                            
-                            msg = await ch.send(embed=embed)
-                            
-                            thread = await msg.create_thread(name=ru_title[:100], auto_archive_duration=1440)
-                            chunks = split_text_for_discord(ru_body)
-                            for chunk in chunks:
-                                await thread.send(chunk)
-                                await asyncio.sleep(1)
-                        except Exception as e:
-                            print(f"Ошибка отправки ветки в Discord: {e}")
-            
-            await db.mark_guide_posted(target_url)
-
+        queued = await game8_crawler.discover()
+        if queued: print(f"📚 Game8: в очередь добавлено гайдов: {queued}")
+        await game8_crawler.drain()
     except Exception as e:
         print(f"Ошибка фонового парсера Game8: {e}")
 
@@ -773,30 +1460,55 @@ async def before_parser():
 # ==================== КЛАСС БОТА ====================
 class ActivityBot(commands.Bot):
     async def setup_hook(self):
+        """Выполняется один раз на процесс до подключения к шлюзу: схема, сиды и подписки не повторяются при реконнектах"""
         self.add_view(TicketView())
         self.add_view(TicketControlsView())
 
+        db_started = time.perf_counter()
+        await db.init_db()
+        await db.init_achievements()
+        await achievement_engine.load()
+        await db.init_profile_themes()
+        await shop_catalog.load_themes()
+        await rep_cooldowns.warm()
+        await db.listen_guild_config()
+        startup_timings['db'] = time.perf_counter() - db_started
+        if telegram.enabled: await telegram.start_polling()
+
     async def close(self):
         print("\n🛑 Получен сигнал на выключение. Сохраняем данные...")
-        now = datetime.datetime.now(datetime.timezone.utc)
-        saved_count = 0
-        
-        for user_id_str, session_start in list(voice_sessions.items()):
-            duration = (now - session_start).total_seconds() / 60
-            if duration >= 1:
-                member_id = int(user_id_str)
-                await db.add_voice_time(member_id, int(duration))
-                coin_gain = int(duration) // 5
-                if coin_gain > 0: await db.add_coins(member_id, coin_gain)
-                await db.add_xp(member_id, int(duration) * 2)
-                saved_count += 1
-                
-        print(f"✅ Сохранено голосовых сессий: {saved_count}")
+        check_voice_time.cancel()
+        try:
+            saved_count = await asyncio.wait_for(flush_voice_sessions(), timeout=VOICE_FLUSH_TIMEOUT)
+            print(f"✅ Сохранено голосовых сессий: {saved_count}")
+        except asyncio.TimeoutError:
+            print("⚠️ Не успели сохранить голосовые сессии — они будут восстановлены из журнала при запуске")
+        except Exception as e:
+            print(f"❌ Ошибка сохранения голосовых сессий: {e}")
+
+        flush_activity.stop()
+        await activity_buffer.flush()
+        print("✅ Буфер активности сброшен в БД")
+
+        fold_coins.stop()
+        try: await db.fold_coins()
+        except Exception as e: print(f"❌ Ошибка переноса монет в журнал: {e}")
+
+        flush_logs.stop()
+        try:
+            await asyncio.wait_for(log_queue.drain(), timeout=VOICE_FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Не отправлено записей лога: {log_queue.depth}")
 
+        listener, db.listener = db.listener, None
+        if listener and not listener.is_closed():
+            await listener.close()
         if db.pool:
             await db.pool.close()
             print("🔌 Соединение с БД корректно закрыто.")
             
+        await http_client.close()
+
         if telegram.enabled:
             await telegram.close()
             print("📱 Соединение с Telegram закрыто.")
@@ -808,11 +1520,109 @@ bot = ActivityBot(command_prefix="!", intents=intents, help_command=None)
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 async def get_guild_config(guild_id: int):
-    if guild_id not in guild_config_cache:
-        guild_config_cache[guild_id] = await db.get_guild_config(guild_id)
-    return guild_config_cache[guild_id]
+    """Настройки гильдии из кэша. Кэш обновляется в update_guild_config и по NOTIFY из других процессов"""
+    config = guild_config_cache.get(guild_id)
+    if config is None:
+        config = await refresh_guild_config(guild_id)
+    return config
+
+async def refresh_guild_config(guild_id: int):
+    """Перечитывает настройки гильдии в кэш: запись не удаляется, а заменяется свежей строкой"""
+    config = guild_config_cache[guild_id] = await db.get_guild_config(guild_id)
+    return config
+
+async def warm_guild_config_cache():
+    configs = await db.get_all_guild_configs()
+    for guild in bot.guilds:
+        guild_config_cache[guild.id] = configs.get(guild.id) or db.default_guild_config(guild.id)
+
+def cached_guild_config(guild) -> dict:
+    """Настройки из кэша без запроса; для гильдии, которой ещё нет в кэше, — настройки по умолчанию"""
+    return guild_config_cache.get(guild.id) or Database.default_guild_config(guild.id)
+
+def economy_enabled(guild) -> bool:
+    return guild is None or cached_guild_config(guild)['economy_enabled']
+
+def achievements_enabled(guild) -> bool:
+    return guild is None or cached_guild_config(guild)['achievements_enabled']
+
+class LogQueue:
+    """Лог-события копятся по каналам и отправляются пачками: до 10 embed и 6000 символов в сообщении"""
+    MAX_PENDING = 200           # на канал; лишние события отбрасываются и попадают в сводку
+    MAX_MESSAGES_PER_FLUSH = 5  # остальное ждёт следующего сброса, чтобы не упираться в лимит канала
+    EMBEDS_PER_MESSAGE = 10
+    MESSAGE_CHAR_LIMIT = 6000
+
+    def __init__(self):
+        self.channels: Dict[int, discord.abc.Messageable] = {}
+        self.pending: Dict[int, deque] = {}
+        self.dropped: Dict[int, int] = {}
+        self.stats = {'messages': 0, 'embeds': 0, 'dropped': 0}
+        self.lock = asyncio.Lock()
+
+    @property
+    def depth(self) -> int:
+        return sum(len(q) for q in self.pending.values())
+
+    def enqueue(self, channel, embed: discord.Embed) -> bool:
+        queue = self.pending.setdefault(channel.id, deque())
+        self.channels[channel.id] = channel
+        if len(queue) >= self.MAX_PENDING:
+            self.dropped[channel.id] = self.dropped.get(channel.id, 0) + 1
+            self.stats['dropped'] += 1
+            return False
+        queue.append(embed)
+        return True
+
+    def _take_batch(self, queue: deque) -> List[discord.Embed]:
+        batch, size = [], 0
+        while queue and len(batch) < self.EMBEDS_PER_MESSAGE and size + len(queue[0]) <= self.MESSAGE_CHAR_LIMIT:
+            embed = queue.popleft()
+            batch.append(embed)
+            size += len(embed)
+        return batch
+
+    async def _flush_channel(self, channel_id: int):
+        channel, queue = self.channels[channel_id], self.pending[channel_id]
+        dropped = self.dropped.pop(channel_id, 0)
+        if dropped:
+            queue.append(discord.Embed(
+                title="⚠️ Слишком много событий",
+                description=f"Пропущено записей в логе: **{dropped}**",
+                color=0xe67e22, timestamp=get_moscow_time()
+            ))
+        for _ in range(self.MAX_MESSAGES_PER_FLUSH):
+            batch = self._take_batch(queue)
+            if not batch: break
+            try:
+                await channel.send(embeds=batch)
+                self.stats['messages'] += 1
+                self.stats['embeds'] += len(batch)
+            except (discord.Forbidden, discord.NotFound):
+                queue.clear()
+            except Exception as e:
+                print(f"❌ Logger error: {e}")
+                break
+        if not queue:
+            self.pending.pop(channel_id, None)
+            self.channels.pop(channel_id, None)
+
+    async def flush(self):
+        async with self.lock:
+            await asyncio.gather(*(self._flush_channel(cid) for cid in list(self.pending)))
+
+    async def drain(self):
+        while self.pending:
+            before = self.depth
+            await self.flush()
+            if self.depth >= before: break
+
+log_queue = LogQueue()
 
 class Logger:
+    EVENT_KEYS = {"voice": "voice_events", "role": "role_events", "member": "member_events", "channel": "channel_events", "server": "server_events", "message": "message_events", "command": "command_events", "achievement": "role_events", "economy": "command_events"}
+    SUBSYSTEM_KEYS = {"achievement": "achievements_enabled", "economy": "economy_enabled"}
+
     @staticmethod
     async def log_event(guild, event_type, title, description, color=None, fields=None, user=None, target=None, channel=None):
         try:
@@ -820,12 +1630,12 @@ class Logger:
             log_ch_id = config.get('log_channel')
             if not log_ch_id: return
             
+            for keys in (Logger.EVENT_KEYS, Logger.SUBSYSTEM_KEYS):
+                if event_type in keys and not config.get(keys[event_type], True): return
+
             log_channel_obj = guild.get_channel(log_ch_id)
             if not log_channel_obj: return
             
-            config_keys = {"voice": "voice_events", "role": "role_events", "member": "member_events", "channel": "channel_events", "server": "server_events", "message": "message_events", "command": "command_events", "achievement": "role_events", "economy": "command_events"}
-            if event_type in config_keys and not config.get(config_keys[event_type], True): return
-            
             embed = discord.Embed(title=f"📝 {title}", description=description, color=color or 0x95a5a6, timestamp=get_moscow_time())
             if user: embed.add_field(name="👤 Пользователь", value=f"{user.mention}\nID: `{user.id}`", inline=True)
             if target: embed.add_field(name="🎯 Цель", value=f"{target.mention}\nID: `{target.id}`", inline=True)
@@ -833,7 +1643,7 @@ class Logger:
             if fields:
                 for k, v in fields.items(): embed.add_field(name=k, value=str(v), inline=False)
             embed.set_footer(text="Время МСК")
-            await log_channel_obj.send(embed=embed)
+            log_queue.enqueue(log_channel_obj, embed)
         except Exception as e: print(f"❌ Logger error: {e}")
 
 class RoleManager:
@@ -844,7 +1654,7 @@ class RoleManager:
 
     @staticmethod
     async def ensure_role_exists(guild: discord.Guild, role_name: str):
-        role = discord.utils.get(guild.roles, name=role_name)
+        role = role_index.get(guild, role_name)
         if role: return role
         try:
             color = discord.Color.from_rgb((hash(role_name) & 0xFF0000) >> 16, (hash(role_name) & 0x00FF00) >> 8, hash(role_name) & 0x0000FF)
@@ -856,26 +1666,25 @@ class RoleManager:
     @staticmethod
     async def give_default_role(member: discord.Member):
         try:
-            for level_role in LEVEL_ROLES.values():
-                if discord.utils.get(member.guild.roles, name=level_role) in member.roles: return
+            if any(r.name in LEVEL_ROLE_NAMES for r in member.roles): return
             role = await RoleManager.ensure_role_exists(member.guild, DEFAULT_ROLE_NAME)
             if role and role not in member.roles and await RoleManager.check_hierarchy(member.guild, role):
                 await member.add_roles(role, reason="Начальная роль")
         except Exception as e: print(f"❌ Ошибка выдачи начальной роли: {e}")
 
     @staticmethod
-    async def check_and_give_roles(member: discord.Member):
+    async def check_and_give_roles(member: discord.Member, current_level: int = None):
+        """Синхронизирует уровневую роль. Уровень передаётся из начисления опыта, иначе читается из БД"""
         try:
-            level_info = await db.get_level_info(member.id)
-            current_level = level_info['level']
-            target_role_name = next((LEVEL_ROLES[t] for t in sorted(LEVEL_ROLES.keys(), reverse=True) if current_level >= t), None)
+            if current_level is None:
+                current_level = (await db.get_level_info(member.id))['level']
+            target_role_name = role_name_for_level(current_level)
             if not target_role_name: return
             
             target_role = await RoleManager.ensure_role_exists(member.guild, target_role_name)
             if not target_role or target_role in member.roles or not await RoleManager.check_hierarchy(member.guild, target_role): return
             
-            roles_to_remove = [discord.utils.get(member.guild.roles, name=r) for r in list(LEVEL_ROLES.values()) + [DEFAULT_ROLE_NAME] if r != target_role_name]
-            roles_to_remove = [r for r in roles_to_remove if r and r in member.roles]
+            roles_to_remove = [r for r in member.roles if r.name in MANAGED_ROLE_NAMES and r.name != target_role_name]
             
             if roles_to_remove: await member.remove_roles(*roles_to_remove, reason="Обновление уровня")
             await member.add_roles(target_role, reason=f"Достиг уровня {current_level}")
@@ -884,76 +1693,425 @@ class RoleManager:
                 await telegram.send_alert("🎉 Новая роль", f"**{member.display_name}** -> **{target_role_name}**\nУровень: {current_level}", "success")
         except Exception as e: print(f"❌ Ошибка обновления ролей: {e}")
 
+class LRUCache:
+    """Ограниченный LRU-кэш со счётчиками попаданий"""
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize: self.data.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+# ==================== ЛИДЕРБОРДЫ ====================
+class Leaderboards:
+    """Топ-N по каждой доске и места пользователей в памяти с коротким TTL; одновременные промахи топа ждут один запрос"""
+    TTL = 30
+    SIZE = 25
+    MAX_RANKS = 5000
+
+    def __init__(self):
+        self.boards: Dict[str, tuple] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.ranks: Dict[Tuple[str, int], tuple] = {}
+
+    async def top(self, board: str, limit: int = 10):
+        cached = self.boards.get(board)
+        if cached and cached[0] > time.monotonic(): return cached[1][:limit]
+        async with self.locks.setdefault(board, asyncio.Lock()):
+            cached = self.boards.get(board)
+            if cached and cached[0] > time.monotonic(): return cached[1][:limit]
+            rows = await db.get_leaderboard(board, self.SIZE)
+            self.boards[board] = (time.monotonic() + self.TTL, rows)
+            return rows[:limit]
+
+    async def rank(self, board: str, user_id: int):
+        now = time.monotonic()
+        cached = self.ranks.get((board, user_id))
+        if cached and cached[0] > now: return cached[1]
+        rank = await db.get_rank(board, user_id)
+        if len(self.ranks) >= self.MAX_RANKS:
+            self.ranks = {k: v for k, v in self.ranks.items() if v[0] > now}
+        self.ranks[(board, user_id)] = (now + self.TTL, rank)
+        return rank
+
+leaderboards = Leaderboards()
+
+class RepCooldowns:
+    """Кулдауны !rep в памяти: повторные попытки отклоняются без запроса к БД. Источник истины — give_reputation"""
+    def __init__(self):
+        self.last_rep: Dict[int, float] = {}
+
+    async def warm(self):
+        self.last_rep = await db.get_rep_cooldowns()
+
+    def remaining(self, user_id: int) -> int:
+        last = self.last_rep.get(user_id)
+        if last is None: return 0
+        left = int(last + db.REP_COOLDOWN - time.time())
+        if left <= 0:
+            del self.last_rep[user_id]
+            return 0
+        return left
+
+    def mark(self, user_id: int, remaining: int):
+        self.last_rep[user_id] = time.time() + remaining - db.REP_COOLDOWN
+
+rep_cooldowns = RepCooldowns()
+
+LEADERBOARD_ALIASES = {
+    'голос': 'voice', 'voice': 'voice', 'войс': 'voice',
+    'сообщения': 'messages', 'messages': 'messages', 'чат': 'messages',
+    'уровни': 'levels', 'levels': 'levels', 'уровень': 'levels', 'опыт': 'levels',
+    'монеты': 'economy', 'economy': 'economy', 'экономика': 'economy', 'баланс': 'economy',
+    'репутация': 'reputation', 'reputation': 'reputation', 'реп': 'reputation', 'rep': 'reputation',
+}
+LEADERBOARD_TITLES = {'voice': "🎤 Топ по голосу", 'messages': "💬 Топ по сообщениям", 'levels': "📈 Топ по уровням", 'economy': "💰 Топ по монетам", 'reputation': "⭐ Топ по репутации"}
+
+def format_leaderboard_value(board: str, row: tuple):
+    if board == 'voice': return f"{row[1] // 60}ч {row[1] % 60}м"
+    if board == 'levels': return f"ур. {row[1]} ({row[2]} XP)"
+    if board == 'economy': return f"{row[1]:,} 🪙"
+    return f"{row[1]:,}"
+
+# ==================== ДОСТИЖЕНИЯ ====================
+class AchievementEngine:
+    """Пороговые достижения в памяти: для каждой метрики отсортированный список порогов,
+    пересечения old < порог <= new ищутся бинарным поиском без запросов к БД"""
+    METRICS = ('messages', 'voice_minutes')
+
+    def __init__(self):
+        self.thresholds: Dict[str, List[int]] = {}
+        self.ids: Dict[str, List[int]] = {}
+        self.by_id: Dict[int, dict] = {}
+        self.by_name: Dict[str, dict] = {}
+
+    async def load(self):
+        rows = await db.get_all_achievements()
+        self.by_id = {a['id']: a for a in rows}
+        self.by_name = {a['name']: a for a in rows}
+        index = {}
+        for a in rows:
+            if a.get('metric') and a.get('threshold') is not None:
+                index.setdefault(a['metric'], []).append((a['threshold'], a['id']))
+        self.thresholds = {metric: [t for t, _ in sorted(items)] for metric, items in index.items()}
+        self.ids = {metric: [i for _, i in sorted(items)] for metric, items in index.items()}
+
+    def crossed(self, metric: str, old: int, new: int) -> List[int]:
+        thresholds = self.thresholds.get(metric)
+        if not thresholds or new <= old: return []
+        return self.ids[metric][bisect.bisect_right(thresholds, old):bisect.bisect_right(thresholds, new)]
+
+    def crossings(self, totals: Dict[int, dict], deltas: Dict[int, dict]) -> Dict[int, List[int]]:
+        """totals — итоги apply_activity_batch, deltas — на сколько выросли счётчики в этой пачке"""
+        found = {}
+        for uid, total in totals.items():
+            ids = []
+            for metric in self.METRICS:
+                delta = deltas.get(uid, {}).get(metric, 0)
+                if delta and metric in total: ids += self.crossed(metric, total[metric] - delta, total[metric])
+            if 'new_level' in total: ids += self.crossed('level', total['old_level'], total['new_level'])
+            if ids: found[uid] = ids
+        return found
+
+    async def grant(self, found: Dict[int, List[int]], guilds: Dict[int, discord.Guild] = None) -> Dict[int, dict]:
+        """Выдаёт найденные достижения; уровни, полученные за их награды, проверяются повторно"""
+        guilds = guilds or {}
+        found = {uid: ids for uid, ids in found.items() if achievements_enabled(guilds.get(uid))}
+        no_coins = [uid for uid in found if not economy_enabled(guilds.get(uid))]
+        granted = {}
+        while found:
+            pairs = [(uid, aid) for uid, ids in found.items() for aid in ids]
+            result = await db.grant_achievements([u for u, _ in pairs], [a for _, a in pairs], no_coins)
+            found = {}
+            for uid, r in result.items():
+                entry = granted.setdefault(uid, {'achievements': []})
+                entry['achievements'] += r['achievements']
+                if 'new_level' in r:
+                    entry.setdefault('old_level', r['old_level'])
+                    entry['new_level'] = r['new_level']
+                    more = self.crossed('level', r['old_level'], r['new_level'])
+                    if more: found[uid] = more
+
+        for uid, entry in granted.items():
+            guild = guilds.get(uid)
+            if not guild: continue
+            for aid in entry['achievements']:
+                ach = self.by_id.get(aid)
+                if ach:
+                    coins = ach['coin_reward'] if economy_enabled(guild) else 0
+                    await Logger.log_event(guild, "achievement", "🏆 Получено достижение", f"{ach['icon']} **{ach['description']}**", 0xffd700, user=guild.get_member(uid), fields={"Опыт": f"+{ach['xp_reward']}", "Монеты": f"+{coins}"})
+        return granted
+
+    async def process(self, totals: Dict[int, dict], deltas: Dict[int, dict], guilds: Dict[int, discord.Guild] = None):
+        """Проверяет пересечения после начисления активности и дописывает в totals уровни, полученные за награды"""
+        found = self.crossings(totals, deltas)
+        if not found: return {}
+        try:
+            granted = await self.grant(found, guilds)
+        except Exception as e:
+            print(f"❌ Ошибка выдачи достижений: {e}")
+            return {}
+        for uid, entry in granted.items():
+            total = totals.get(uid)
+            if total is not None and entry.get('new_level', 0) > total.get('new_level', 0):
+                total.setdefault('old_level', entry['old_level'])
+                total['new_level'] = entry['new_level']
+        return granted
+
+    async def award(self, user_id: int, name: str, guild: discord.Guild = None) -> bool:
+        """Выдача достижения по событию (не по порогу), например first_purchase. Новый уровень за награду обрабатывается как обычный"""
+        ach = self.by_name.get(name)
+        if not ach: return False
+        entry = (await self.grant({user_id: [ach['id']]}, {user_id: guild})).get(user_id)
+        if not entry: return False
+        member = guild.get_member(user_id) if guild else None
+        if member and entry.get('new_level', 0) > entry.get('old_level', 0):
+            await _notify_level_up(member, entry['new_level'])
+        return True
+
+    async def backfill(self):
+        """Выдаёт все уже достигнутые пороговые достижения существующим пользователям. Возвращает (пользователей, достижений)"""
+        found = {}
+        for uid, aid in await db.get_achievement_backlog():
+            found.setdefault(uid, []).append(aid)
+        granted = await self.grant(found)
+        return len(granted), sum(len(e['achievements']) for e in granted.values())
+
+achievement_engine = AchievementEngine()
+
+# ==================== БУФЕР АКТИВНОСТИ ====================
+class ActivityBuffer:
+    """Копит счётчики сообщений, монет и опыта в памяти и сбрасывает их в БД одной пачкой"""
+
+    def __init__(self):
+        self.pending: Dict[int, dict] = {}
+        self.lock = asyncio.Lock()
+
+    def record_message(self, author, guild=None, coins: int = 2, xp: int = 5):
+        entry = self.pending.get(author.id)
+        if entry is None:
+            entry = self.pending[author.id] = {'messages': 0, 'coins': 0, 'xp': 0, 'user': author, 'guild': None, 'members': {}}
+        entry['messages'] += 1
+        entry['coins'] += coins
+        entry['xp'] += xp
+        entry['user'] = author
+        if guild: entry['guild'] = guild
+        if isinstance(author, discord.Member): entry['members'][author.guild.id] = author
+
+    def _restore(self, batch: Dict[int, dict]):
+        for uid, entry in batch.items():
+            current = self.pending.get(uid)
+            if current is None:
+                self.pending[uid] = entry
+                continue
+            for key in ('messages', 'coins', 'xp'): current[key] += entry[key]
+            current['guild'] = current['guild'] or entry['guild']
+            for gid, member in entry['members'].items(): current['members'].setdefault(gid, member)
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending: return
+            batch, self.pending = self.pending, {}
+            user_ids = list(batch)
+            try:
+                totals = await db.apply_activity_batch(
+                    user_ids,
+                    [batch[u]['messages'] for u in user_ids],
+                    [0] * len(user_ids),
+                    [batch[u]['coins'] for u in user_ids],
+                    [batch[u]['xp'] for u in user_ids],
+                    'messages'
+                )
+            except Exception as e:
+                print(f"❌ Ошибка сброса буфера активности: {e}")
+                self._restore(batch)
+                return
+
+        await achievement_engine.process(
+            totals, {u: {'messages': batch[u]['messages']} for u in user_ids}, {u: batch[u]['guild'] for u in user_ids}
+        )
+        for uid in user_ids:
+            if uid in totals:
+                try: await self._after_flush(uid, batch[uid], totals[uid])
+                except Exception as e: print(f"❌ Ошибка обработки активности {uid}: {e}")
+
+    async def _after_flush(self, user_id: int, entry: dict, total: dict):
+        if total.get('new_level', 0) > total.get('old_level', 0):
+            try: await entry['user'].send(f"🎉 Вы достигли **{total['new_level']} уровня**!")
+            except: pass
+            for member in entry['members'].values():
+                await RoleManager.check_and_give_roles(member, total['new_level'])
+
+activity_buffer = ActivityBuffer()
+
+# ==================== ГОЛОСОВЫЕ СЕССИИ ====================
+VOICE_TICK_MINUTES = 5
+VOICE_FLUSH_TIMEOUT = 10
+
+def _voice_rewards(minutes: int, economy: bool = True):
+    """Награда за завершённую сессию: (минуты, монеты, опыт)"""
+    return minutes, minutes // 5 if economy else 0, minutes * 2
+
+async def flush_voice_sessions():
+    """Начисляет все открытые сессии одной пачкой и закрывает их в журнале той же транзакцией"""
+    now = time.monotonic()
+    keys, awards, guilds = list(voice_sessions), {}, {}
+    for key in keys:
+        minutes = int((now - voice_sessions[key]) / 60)
+        if minutes < 1: continue
+        guilds.setdefault(key[1], bot.get_guild(key[0]))
+        total = awards.setdefault(key[1], [0, 0, 0])
+        for i, value in enumerate(_voice_rewards(minutes, economy_enabled(bot.get_guild(key[0])))): total[i] += value
+    if awards:
+        ids = list(awards)
+        totals = await db.apply_activity_batch(ids, [0] * len(ids), [awards[u][0] for u in ids], [awards[u][1] for u in ids], [awards[u][2] for u in ids], 'voice', end_sessions=keys)
+        await achievement_engine.process(totals, {u: {'voice_minutes': awards[u][0]} for u in ids}, guilds)
+    else:
+        await db.end_voice_sessions(keys)
+    voice_sessions.clear()
+    return len(awards)
+
+async def restore_voice_sessions():
+    """Сверяет журнал сессий и память с реальным состоянием member.voice"""
+    journal = await db.get_voice_sessions()
+    now = time.monotonic()
+    live = set()
+    for guild in bot.guilds:
+        for channel in list(guild.voice_channels) + list(guild.stage_channels):
+            for member in channel.members:
+                if member.bot: continue
+                key = (guild.id, member.id)
+                live.add(key)
+                if key not in voice_sessions:
+                    voice_sessions[key] = now - min(journal.get(key, 0), VOICE_TICK_MINUTES * 60)
+
+    stale = [key for key in set(voice_sessions) | set(journal) if key not in live]
+    for key in stale: voice_sessions.pop(key, None)
+    await db.end_voice_sessions(stale)
+    await db.start_voice_sessions([key for key in live if key not in journal])
+    print(f"🎤 Восстановлено голосовых сессий: {len(live)}, закрыто устаревших: {len(stale)}")
+
 # ==================== СИНХРОННЫЕ ФУНКЦИИ (ДЛЯ ВЫПОЛНЕНИЯ В ОТДЕЛЬНОМ ПОТОКЕ) ====================
+def _draw_activity_panel(ax, dates, values, color, ylabel, title, xlabel=None):
+    ax.bar(dates, values, color=color, alpha=0.8, edgecolor='black', linewidth=0.5)
+    ax.set_ylabel(ylabel, fontsize=12)
+    if xlabel: ax.set_xlabel(xlabel, fontsize=12)
+    ax.set_title(title, fontsize=14, pad=10)
+    ax.grid(axis='y', alpha=0.3)
+    for label in ax.xaxis.get_majorticklabels(): label.set(rotation=45, ha='right')
+
 def _generate_activity_graph_sync(member_name: str, history: list):
+    """Рисует график через объектный API matplotlib: своя Figure на вызов, без глобального состояния pyplot"""
     dates = [row['date'].strftime('%d.%m') for row in history]
     voice_data = [row['voice_minutes'] / 60 for row in history]
     msg_data = [row['messages'] for row in history]
 
-    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 8))
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(12, 8))
+    FigureCanvasAgg(fig)
+    ax1, ax2 = fig.subplots(2, 1)
     fig.suptitle(f'Активность {member_name} (последние 30 дней)', fontsize=16)
 
-    ax1.bar(dates, voice_data, color='#3498db', alpha=0.8, edgecolor='black', linewidth=0.5)
-    ax1.set_ylabel('Часы в голосе', fontsize=12)
-    ax1.set_title('🎤 Голосовая активность', fontsize=14, pad=10)
-    ax1.grid(axis='y', alpha=0.3)
-
-    ax2.bar(dates, msg_data, color='#2ecc71', alpha=0.8, edgecolor='black', linewidth=0.5)
-    ax2.set_ylabel('Сообщения', fontsize=12)
-    ax2.set_xlabel('Дата', fontsize=12)
-    ax2.set_title('💬 Сообщения', fontsize=14, pad=10)
-    ax2.grid(axis='y', alpha=0.3)
-
-    plt.setp(ax1.xaxis.get_majorticklabels(), rotation=45, ha='right')
-    plt.setp(ax2.xaxis.get_majorticklabels(), rotation=45, ha='right')
-    plt.tight_layout()
+    _draw_activity_panel(ax1, dates, voice_data, '#3498db', 'Часы в голосе', '🎤 Голосовая активность')
+    _draw_activity_panel(ax2, dates, msg_data, '#2ecc71', 'Сообщения', '💬 Сообщения', xlabel='Дата')
+    fig.tight_layout()
 
     buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=120, bbox_inches='tight')
+    fig.savefig(buf, format='png', dpi=120, bbox_inches='tight')
     buf.seek(0)
-    plt.close()
     return buf
 
-def _generate_profile_card_sync(display_name, tag, member_id, level_info, balance, stats, achievements, current_role, avatar_bytes, theme):
-    W, H = 1000, 380
-    AVATAR_SIZE = 120
-    AVATAR_X, AVATAR_Y = 30, 30
+activity_graph_cache = LRUCache(256)
 
-    def hex_to_rgb(hex_color, alpha=255):
-        return ((hex_color >> 16) & 0xFF, (hex_color >> 8) & 0xFF, hex_color & 0xFF, alpha)
+CARD_W, CARD_H = 1000, 380
+AVATAR_SIZE = 120
+AVATAR_X, AVATAR_Y = 30, 30
 
-    BG_COLOR = hex_to_rgb(theme['bg_color'])
-    CARD_COLOR = hex_to_rgb(theme['card_color'], 235)
-    ACCENT_COLOR = hex_to_rgb(theme['accent_color'])[:3]
-    TEXT_COLOR = (255, 255, 255)
-    SECONDARY_COLOR = (200, 200, 200)
+def _hex_to_rgb(hex_color, alpha=255):
+    return ((hex_color >> 16) & 0xFF, (hex_color >> 8) & 0xFF, hex_color & 0xFF, alpha)
 
+@functools.lru_cache(maxsize=1)
+def _card_fonts():
+    """Шрифты карточки загружаются один раз на процесс"""
+    from PIL import ImageFont
     try:
-        font_large = ImageFont.truetype("Roboto-Medium.ttf", 32)
-        font_medium = ImageFont.truetype("Roboto-Medium.ttf", 24)
-        font_small = ImageFont.truetype("Roboto-Medium.ttf", 20)
-        font_micro = ImageFont.truetype("Roboto-Medium.ttf", 14)
+        return tuple(ImageFont.truetype("Roboto-Medium.ttf", size) for size in (32, 24, 20, 14))
     except IOError:
-        font_large = font_medium = font_small = font_micro = ImageFont.load_default()
-
-    img = Image.new('RGBA', (W, H), BG_COLOR)
-    draw = ImageDraw.Draw(img)
+        return (ImageFont.load_default(),) * 4
+
+@functools.lru_cache(maxsize=32)
+def _theme_background(theme_id, accent_color, card_color):
+    """Фон темы (градиент и рамка карточки) рисуется один раз на строку profile_themes"""
+    from PIL import Image, ImageDraw
+    accent = _hex_to_rgb(accent_color)[:3]
+    img = Image.new('RGBA', (CARD_W, CARD_H), (*accent, 0))
+    gradient = Image.new('L', (1, CARD_H))
+    gradient.putdata([int(8 * (1 - i / CARD_H)) for i in range(CARD_H)])
+    img.putalpha(gradient.resize((CARD_W, CARD_H), Image.NEAREST))
+    ImageDraw.Draw(img).rounded_rectangle([15, 15, CARD_W - 15, CARD_H - 15], radius=20, fill=_hex_to_rgb(card_color, 235), outline=accent, width=3)
+    return img
+
+def _profile_card_key(display_name, tag, level_info, balance, stats, achievements, current_role, avatar_key, theme):
+    """Хэш всех входных данных карточки: одинаковый профиль не перерисовывается"""
+    payload = (
+        display_name, tag, level_info['level'], level_info['xp'], round(level_info['progress'], 4), balance,
+        stats['messages'], stats['voice_minutes'], tuple((a['icon'], a['description']) for a in achievements),
+        current_role, avatar_key, theme['id'], theme['accent_color'], theme['card_color']
+    )
+    return hashlib.sha1(repr(payload).encode()).hexdigest()
+
+profile_card_cache = LRUCache(256)
+profile_render_stats = {'renders': 0, 'render_ms': 0.0}
+
+@functools.lru_cache(maxsize=1)
+def _avatar_mask():
+    from PIL import Image, ImageDraw
+    mask = Image.new('L', (AVATAR_SIZE, AVATAR_SIZE), 0)
+    ImageDraw.Draw(mask).ellipse((0, 0, AVATAR_SIZE, AVATAR_SIZE), fill=255)
+    return mask
+
+def _avatar_tile_sync(avatar_bytes: bytes):
+    """Декодирует аватар, уменьшает до размера карточки и обрезает кругом"""
+    from PIL import Image
+    avatar_img = Image.open(io.BytesIO(avatar_bytes)).convert('RGBA')
+    avatar_img = avatar_img.resize((AVATAR_SIZE, AVATAR_SIZE), Image.LANCZOS)
+    avatar_img.putalpha(_avatar_mask())
+    return avatar_img
+
+avatar_tile_cache = LRUCache(512)
+
+def _generate_profile_card_sync(display_name, tag, member_id, level_info, balance, stats, achievements, current_role, avatar_tile, theme):
+    from PIL import ImageDraw
+    W = CARD_W
+    ACCENT_COLOR = _hex_to_rgb(theme['accent_color'])[:3]
+    TEXT_COLOR = (255, 255, 255)
+    SECONDARY_COLOR = (200, 200, 200)
 
-    for i in range(H):
-        alpha = int(8 * (1 - i / H))
-        draw.line([(0, i), (W, i)], fill=(*ACCENT_COLOR[:3], alpha))
+    font_large, font_medium, font_small, font_micro = _card_fonts()
 
-    draw.rounded_rectangle([15, 15, W - 15, H - 15], radius=20, fill=CARD_COLOR, outline=ACCENT_COLOR, width=3)
+    img = _theme_background(theme['id'], theme['accent_color'], theme['card_color']).copy()
+    draw = ImageDraw.Draw(img)
 
-    if avatar_bytes:
-        try:
-            avatar_img = Image.open(io.BytesIO(avatar_bytes)).convert('RGBA')
-            avatar_img = avatar_img.resize((AVATAR_SIZE, AVATAR_SIZE), Image.LANCZOS)
-            mask = Image.new('L', avatar_img.size, 0)
-            ImageDraw.Draw(mask).ellipse((0, 0, AVATAR_SIZE, AVATAR_SIZE), fill=255)
-            avatar_img.putalpha(mask)
-            img.paste(avatar_img, (AVATAR_X, AVATAR_Y), avatar_img)
-        except Exception: pass
+    if avatar_tile:
+        img.paste(avatar_tile, (AVATAR_X, AVATAR_Y), avatar_tile)
 
     name_x = AVATAR_X + AVATAR_SIZE + 20
     draw.text((name_x, 40), display_name, font=font_large, fill=ACCENT_COLOR)
@@ -985,24 +2143,65 @@ def _generate_profile_card_sync(display_name, tag, member_id, level_info, balanc
     return buf
 
 # ==================== ЗАДАЧИ АКТИВНОСТИ ====================
+@tasks.loop(seconds=5)
+async def flush_activity():
+    await activity_buffer.flush()
+
+@tasks.loop(seconds=3)
+async def flush_logs():
+    await log_queue.flush()
+
 @tasks.loop(minutes=5)
+async def fold_coins():
+    try: await db.fold_coins()
+    except Exception as e: print(f"❌ Ошибка переноса монет в журнал: {e}")
+
+async def _notify_level_up(member: discord.Member, new_level: int):
+    try: await member.send(f"🎉 Поздравляю! Вы достигли **{new_level} уровня**!")
+    except: pass
+    await RoleManager.check_and_give_roles(member, new_level)
+
+@tasks.loop(minutes=VOICE_TICK_MINUTES)
 async def check_voice_time():
-    now = datetime.datetime.now(datetime.timezone.utc)
-    for user_id_str, session_start in list(voice_sessions.items()):
-        duration = (now - session_start).total_seconds() / 60
-        member_id = int(user_id_str)
-        for guild in bot.guilds:
-            member = guild.get_member(member_id)
-            if member and member.voice and member.voice.channel:
-                await db.add_voice_time(member_id, 5)
-                await db.add_coins(member_id, 1)
-                leveled_up, new_level = await db.add_xp(member_id, 10)
-                if leveled_up:
-                    try: await member.send(f"🎉 Поздравляю! Вы достигли **{new_level} уровня**!")
-                    except: pass
-                await RoleManager.check_and_give_roles(member)
-                voice_sessions[user_id_str] = now - datetime.timedelta(minutes=duration % 5)
-                break
+    """Голосовой тик: находит активных участников по ключам (guild, user) и начисляет награды одной пачкой"""
+    started = time.perf_counter()
+    now = time.monotonic()
+    active, keys, remainders, previous = {}, [], [], {}
+    for key, session_start in list(voice_sessions.items()):
+        guild = bot.get_guild(key[0])
+        member = guild.get_member(key[1]) if guild else None
+        if member and member.voice and member.voice.channel:
+            active[member.id] = member
+            remainder = (now - session_start) % (VOICE_TICK_MINUTES * 60)
+            voice_sessions[key] = now - remainder
+            previous[key] = session_start
+            keys.append(key)
+            remainders.append(remainder)
+
+    level_ups = []
+    if active:
+        ids, n = list(active), len(active)
+        try:
+            coins = [1 if economy_enabled(active[u].guild) else 0 for u in ids]
+            totals = await db.apply_activity_batch(ids, [0] * n, [VOICE_TICK_MINUTES] * n, coins, [10] * n, 'voice')
+        except Exception as e:
+            # Минуты тика не начислены: возвращаем прежнее начало сессий, чтобы их засчитал следующий тик или выход
+            for key, remainder in zip(keys, remainders):
+                if voice_sessions.get(key) == now - remainder:
+                    voice_sessions[key] = previous[key]
+            print(f"❌ Ошибка голосового тика: {e}")
+            return
+        # Начисление уже прошло, поэтому ошибка журнала только логируется: при рестарте остаток может быть засчитан повторно
+        try: await db.advance_voice_sessions(keys, remainders)
+        except Exception as e: print(f"❌ Ошибка сдвига журнала голосовых сессий: {e}")
+        await achievement_engine.process(totals, {u: {'voice_minutes': VOICE_TICK_MINUTES} for u in ids}, {u: active[u].guild for u in ids})
+        level_ups = [(m, totals[m.id]['new_level']) for m in active.values() if m.id in totals and totals[m.id]['new_level'] > totals[m.id]['old_level']]
+        if level_ups:
+            await asyncio.gather(*(_notify_level_up(m, lvl) for m, lvl in level_ups))
+
+    voice_tick_stats.update(members=len(active), level_ups=len(level_ups), duration_ms=(time.perf_counter() - started) * 1000)
+    if active:
+        print(f"🎤 Голосовой тик: {len(active)} участников, {len(level_ups)} новых уровней, {voice_tick_stats['duration_ms']:.0f} мс")
 
 @tasks.loop(hours=24)
 async def daily_report():
@@ -1011,39 +2210,105 @@ async def daily_report():
 
 @tasks.loop(time=datetime_time(hour=0, minute=5))
 async def collect_stats():
+    await activity_buffer.flush()
+    today = datetime.date.today()
     for guild in bot.guilds:
-        for m in guild.members:
-            if not m.bot:
-                s = await db.get_user_stats(m.id)
-                await db.save_daily_stats(m.id, guild.id, s['voice_minutes'], s['messages'])
-        await db.save_server_stats(guild.id)
+        started = time.perf_counter()
+        member_ids = [m.id for m in guild.members if not m.bot]
+        new_members = sum(1 for m in guild.members if m.joined_at and m.joined_at.date() == today)
+        try: await db.save_guild_snapshot(guild.id, member_ids, new_members, today)
+        except Exception as e:
+            print(f"❌ Ошибка снимка статистики {guild.name}: {e}")
+            continue
+        print(f"📊 Снимок {guild.name}: {len(member_ids)} участников за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+# Bot API принимает документы до 50 МБ, дамп режется на части с запасом
+BACKUP_PART_LIMIT = 45 * 1024 * 1024
+BACKUP_READ_CHUNK = 256 * 1024
+backup_stats = {}
+
+async def stream_backup(caption: str) -> Tuple[bool, str]:
+    """pg_dump (custom-формат) → gzip → документы Telegram: без временных файлов и без блокировки цикла событий"""
+    pg_dump_path = shutil.which("pg_dump")
+    if not pg_dump_path:
+        return False, "❌ Утилита `pg_dump` не найдена в системе. Убедитесь, что `postgresql` добавлен в Nixpacks на Railway."
+    db_url = os.environ.get("DATABASE_URL")
+    if not db_url:
+        return False, "❌ Не найдена переменная `DATABASE_URL`."
+
+    start = time.perf_counter()
+    filename = f"backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.dump.gz"
+    proc = await asyncio.create_subprocess_exec(
+        pg_dump_path, db_url, "-Fc", "-Z0", "-T", "user_history",
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 — формат gzip
+    raw_size = compressed_size = parts = 0
+    buffer = bytearray()
+    uploaded = True
+
+    async def upload(data: bytes, part_caption: str, last: bool = False):
+        nonlocal parts, uploaded
+        parts += 1
+        # Части склеиваются обратно: cat backup_*.part* > backup.dump.gz
+        name = filename if last and parts == 1 else f"{filename}.part{parts:02d}"
+        uploaded = await telegram.send_document(data, name, part_caption) and uploaded
+
+    try:
+        while chunk := await proc.stdout.read(BACKUP_READ_CHUNK):
+            raw_size += len(chunk)
+            buffer += await asyncio.to_thread(compressor.compress, chunk)
+            while len(buffer) > BACKUP_PART_LIMIT:
+                data = bytes(buffer[:BACKUP_PART_LIMIT])
+                del buffer[:BACKUP_PART_LIMIT]
+                compressed_size += len(data)
+                await upload(data, f"{caption}\nЧасть {parts + 1}")
+        buffer += compressor.flush()
+        returncode = await proc.wait()
+        stderr = (await stderr_task).decode(errors='replace')
+    except BaseException:
+        if proc.returncode is None: proc.kill()
+        raise
+
+    if returncode != 0:
+        return False, f"❌ Ошибка при создании бэкапа:\n```text\n{stderr[-1500:]}\n```"
+
+    compressed_size += len(buffer)
+    duration = time.perf_counter() - start
+    ratio = compressed_size / raw_size if raw_size else 0
+    report = (f"Дамп {raw_size / 1048576:.1f} МБ → {compressed_size / 1048576:.1f} МБ "
+              f"(сжатие до {ratio:.0%}), частей: {parts + 1}, {duration:.1f} с")
+    part_label = f"Часть {parts + 1}\n" if parts else ""
+    await upload(bytes(buffer), f"{caption}\n{part_label}{report}", last=True)
+    backup_stats.update(raw=raw_size, compressed=compressed_size, parts=parts, duration=duration, at=format_moscow_time())
+    print(f"📦 Бэкап: {report}")
+    if not uploaded:
+        return False, f"⚠️ Бэкап создан, но произошла ошибка при отправке в Telegram. Проверьте ID чата.\n{report}"
+    return True, report
 
 @tasks.loop(time=datetime_time(hour=3, minute=0))
 async def backup_db():
     if not telegram.enabled: return
-    pg_dump_path = subprocess.run(["which", "pg_dump"], capture_output=True, text=True).stdout.strip()
-    if not pg_dump_path: return 
-    
-    db_url = os.environ.get("DATABASE_URL")
-    if not db_url: return
-    
-    filename = f"backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.sql"
-    res = subprocess.run(["pg_dump", db_url, "-T", "user_history", "-f", filename], capture_output=True, text=True)
-    if res.returncode == 0:
-        await telegram.send_document(filename, f"📦 Бэкап БД\n⏰ {format_moscow_time()}")
-        os.remove(filename)
+    ok, report = await stream_backup(f"📦 Бэкап БД\n⏰ {format_moscow_time()}")
+    if not ok: print(f"❌ Ночной бэкап: {report}")
 
 # ==================== СОБЫТИЯ DISCORD ====================
 @bot.event
 async def on_ready():
     print(f"✅ Бот {bot.user} запущен!")
-    await db.init_db()
-    await db.init_achievements()
-    await db.init_profile_themes()
-    
+    if 'ready' not in startup_timings:
+        startup_timings['ready'] = time.perf_counter() - _PROCESS_START
+        print(f"⏱️ Запуск: импорты {startup_timings['import'] * 1000:.0f} мс, инициализация БД {startup_timings.get('db', 0):.2f} с, READY через {startup_timings['ready']:.2f} с")
+
+    await warm_guild_config_cache()
+    await db.listen_guild_config()
+    await restore_voice_sessions()
+    if not flush_activity.is_running(): flush_activity.start()
+    if not flush_logs.is_running(): flush_logs.start()
+    if not fold_coins.is_running(): fold_coins.start()
     if not check_voice_time.is_running(): check_voice_time.start()
     if telegram.enabled and not daily_report.is_running(): daily_report.start()
-    if telegram.enabled: await telegram.start_polling()
     if not collect_stats.is_running(): collect_stats.start()
     if telegram.enabled and not backup_db.is_running(): backup_db.start()
     if not auto_game8_parser.is_running(): auto_game8_parser.start()
@@ -1052,38 +2317,54 @@ async def on_ready():
 async def on_message(message):
     if message.author.bot: return
     if not message.content.startswith('!'):
-        await db.add_message(message.author.id)
-        await db.add_coins(message.author.id, 2)
-        leveled_up, new_level = await db.add_xp(message.author.id, 5)
-        if leveled_up:
-            try: await message.author.send(f"🎉 Вы достигли **{new_level} уровня**!")
-            except: pass
-            
-        if isinstance(message.author, discord.Member):
-            await RoleManager.check_and_give_roles(message.author)
-            
-        s = await db.get_user_stats(message.author.id)
-        if s['messages'] == 100: await db.check_achievement(message.author.id, "chat_100", message.guild)
-        if s['messages'] == 1000: await db.check_achievement(message.author.id, "chat_1000", message.guild)
+        config = await get_guild_config(message.guild.id) if message.guild else {}
+        activity_buffer.record_message(message.author, message.guild, coins=2 if config.get('economy_enabled', True) else 0)
     await bot.process_commands(message)
 
 @bot.event
 async def on_voice_state_update(member, before, after):
     if member.bot: return
-    uid = str(member.id)
-    now = datetime.datetime.now(datetime.timezone.utc)
+    key = (member.guild.id, member.id)
 
     if before.channel is None and after.channel is not None:
-        voice_sessions[uid] = now
+        voice_sessions[key] = time.monotonic()
+        await db.start_voice_sessions([key])
     elif before.channel is not None and after.channel is None:
-        if uid in voice_sessions:
-            dur = (now - voice_sessions[uid]).total_seconds() / 60
-            if dur >= 1:
-                await db.add_voice_time(member.id, int(dur))
-                await db.add_coins(member.id, int(dur) // 5)
-                await db.add_xp(member.id, int(dur) * 2)
-                await RoleManager.check_and_give_roles(member)
-            del voice_sessions[uid]
+        session_start = voice_sessions.pop(key, None)
+        if session_start is None: return
+        dur = int((time.monotonic() - session_start) / 60)
+        if dur < 1:
+            await db.end_voice_sessions([key])
+        else:
+            minutes, coins, xp = _voice_rewards(dur, economy_enabled(member.guild))
+            totals = await db.apply_activity_batch([member.id], [0], [minutes], [coins], [xp], 'voice', end_sessions=[key])
+            await achievement_engine.process(totals, {member.id: {'voice_minutes': minutes}}, {member.id: member.guild})
+            total = totals.get(member.id, {})
+            if total.get('new_level', 0) > total.get('old_level', 0): await RoleManager.check_and_give_roles(member, total['new_level'])
+
+@bot.event
+async def on_guild_role_create(role):
+    role_index.invalidate(role.guild.id)
+
+@bot.event
+async def on_guild_role_delete(role):
+    role_index.invalidate(role.guild.id)
+    shop_catalog.invalidate(role.guild.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    if before.name != after.name:
+        role_index.invalidate(after.guild.id)
+        shop_catalog.invalidate(after.guild.id)
+
+@bot.event
+async def on_guild_join(guild):
+    await refresh_guild_config(guild.id)
+
+@bot.event
+async def on_guild_remove(guild):
+    role_index.invalidate(guild.id)
+    shop_catalog.invalidate(guild.id)
 
 # ==================== КОМАНДЫ DISCORD ====================
 @bot.command(name="гайд", aliases=["guide", "game8"])
@@ -1113,12 +2394,9 @@ async def manual_game8_guide(ctx, url: str):
 
     await loading_msg.delete()
     msg = await ctx.send(embed=embed, view=view)
-    
-    thread = await msg.create_thread(name=ru_title[:100], auto_archive_duration=1440)
-    chunks = split_text_for_discord(ru_body)
-    for chunk in chunks:
-        await thread.send(chunk)
-        await asyncio.sleep(1)
+    pages = pack_guide_embeds(ru_body)
+    if await send_guide_thread(msg, ru_title, pages) < len(pages):
+        await ctx.send("⚠️ Гайд отправлен в ветку не полностью, подробности в логах бота.")
 
 @bot.command(name="канал_гайдов")
 @commands.has_permissions(administrator=True)
@@ -1132,18 +2410,13 @@ async def set_guides_channel(ctx, channel: discord.TextChannel):
 async def set_log_channel_cmd(ctx, channel: discord.TextChannel):
     """Устанавливает канал для логирования событий сервера"""
     await db.set_log_channel(ctx.guild.id, channel.id)
-    
-    if ctx.guild.id in guild_config_cache:
-        del guild_config_cache[ctx.guild.id]
-        
     await ctx.send(f"✅ Канал логов успешно установлен на {channel.mention}")
 
 @bot.command(name="статистика")
 async def stats(ctx, member: discord.Member = None):
     member = member or ctx.author
-    data = await db.get_user_stats(member.id)
-    level_info = await db.get_level_info(member.id)
-    rep = await db.get_reputation(member.id)
+    snapshot = await db.get_profile_snapshot(member.id)
+    data, level_info, rep = snapshot['stats'], snapshot['level_info'], snapshot['reputation']
     
     embed = discord.Embed(title=f"📊 Статистика {member.display_name}", color=discord.Color.blue())
     embed.add_field(name="🎤 Голос", value=f"{data['voice_hours']}ч {data['voice_remaining_minutes']}м", inline=True)
@@ -1159,14 +2432,16 @@ async def give_reputation(ctx, member: discord.Member):
     if member.id == ctx.author.id:
         return await ctx.send("❌ Нельзя выдать репутацию самому себе!")
 
-    can_give, cooldown_sec = await db.can_give_rep(ctx.author.id)
-    if not can_give:
+    cooldown_sec = rep_cooldowns.remaining(ctx.author.id)
+    new_rep = None
+    if not cooldown_sec:
+        new_rep, cooldown_sec = await db.give_reputation(ctx.author.id, member.id)
+        rep_cooldowns.mark(ctx.author.id, cooldown_sec)
+    if new_rep is None:
         hours = cooldown_sec // 3600
         mins = (cooldown_sec % 3600) // 60
         return await ctx.send(f"⏳ Вы уже выдавали репутацию сегодня. Подождите еще **{hours}ч {mins}м**.")
 
-    new_rep = await db.add_reputation(ctx.author.id, member.id)
-
     embed = discord.Embed(
         title="⭐ Плюс к репутации!",
         description=f"{ctx.author.mention} выразил уважение {member.mention}!\nТеперь у него/неё **{new_rep}** ед. репутации.",
@@ -1175,9 +2450,7 @@ async def give_reputation(ctx, member: discord.Member):
     await ctx.send(embed=embed)
 
     if new_rep >= 10:
-        role = discord.utils.get(ctx.guild.roles, name=REP_REWARD_ROLE)
-        if not role:
-            role = await RoleManager.ensure_role_exists(ctx.guild, REP_REWARD_ROLE)
+        role = await RoleManager.ensure_role_exists(ctx.guild, REP_REWARD_ROLE)
             
         if role and role not in member.roles:
             try:
@@ -1186,6 +2459,21 @@ async def give_reputation(ctx, member: discord.Member):
             except discord.Forbidden:
                 pass
 
+@bot.command(name="топ", aliases=["top", "лидеры"])
+async def leaderboard_cmd(ctx, board: str = "уровни"):
+    board = LEADERBOARD_ALIASES.get(board.lower())
+    if not board:
+        return await ctx.send("❌ Доступные топы: `голос`, `сообщения`, `уровни`, `монеты`, `репутация`.")
+
+    rows = await leaderboards.top(board, 10)
+    lines = [f"**{i}.** <@{row[0]}> — {format_leaderboard_value(board, row)}" for i, row in enumerate(rows, 1)]
+    embed = discord.Embed(title=LEADERBOARD_TITLES[board], description="\n".join(lines) or "Пока пусто.", color=discord.Color.gold())
+    rank = await leaderboards.rank(board, ctx.author.id)
+    footer = [f"Ваше место: #{rank}"] if rank else []
+    if board == 'economy': footer.append("доход за активность попадает в топ раз в 5 минут")
+    if footer: embed.set_footer(text=" • ".join(footer))
+    await ctx.send(embed=embed)
+
 @bot.command(name="график", aliases=["graph"])
 async def activity_graph(ctx, member: discord.Member = None):
     member = member or ctx.author
@@ -1194,51 +2482,81 @@ async def activity_graph(ctx, member: discord.Member = None):
         if not history:
             return await ctx.send("❌ Недостаточно данных.")
         history.reverse()
+
+        # user_history пополняется раз в сутки, поэтому дата последней записи однозначно определяет график
+        key = (member.id, ctx.guild.id, history[-1]['date'], member.display_name)
+        png = activity_graph_cache.get(key)
+        if png is None:
+            png = (await asyncio.to_thread(_generate_activity_graph_sync, member.display_name, history)).getvalue()
+            activity_graph_cache.put(key, png)
         
-        buf = await asyncio.to_thread(_generate_activity_graph_sync, member.display_name, history)
-        
-        file = discord.File(buf, filename='activity.png')
+        file = discord.File(io.BytesIO(png), filename='activity.png')
         embed = discord.Embed(title=f"📈 Активность {member.display_name}", color=discord.Color.blue())
         embed.set_image(url="attachment://activity.png")
         await ctx.send(embed=embed, file=file)
 
-async def fetch_avatar(member: discord.Member, size: int = 256) -> bytes:
+async def fetch_avatar(member: discord.Member, size: int = 128) -> bytes:
+    """Скачивает аватар сразу нужного размера с CDN Discord"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(member.display_avatar.url) as resp:
-                if resp.status == 200: return await resp.read()
+        session = await http_client.get_session()
+        async with session.get(member.display_avatar.replace(size=size, format='png').url) as resp:
+            if resp.status == 200: return await resp.read()
     except: pass
     return None
 
+async def get_avatar_tile(member: discord.Member):
+    """Готовая круглая плитка аватара из LRU по хэшу аватара; сеть и декодирование только при промахе"""
+    key = member.display_avatar.key
+    tile = avatar_tile_cache.get(key)
+    if tile is None:
+        avatar_bytes = await fetch_avatar(member)
+        if not avatar_bytes: return None
+        try: tile = await asyncio.to_thread(_avatar_tile_sync, avatar_bytes)
+        except Exception: return None
+        avatar_tile_cache.put(key, tile)
+    return tile
+
 @bot.command(name="профиль", aliases=["rank", "profile"])
 async def profile(ctx, member: discord.Member = None):
     member = member or ctx.author
     async with ctx.typing():
-        level_info = await db.get_level_info(member.id)
-        balance = await db.get_balance(member.id)
-        stats = await db.get_user_stats(member.id)
-        achievements = await db.get_user_achievements(member.id)
-        profile_settings = await db.get_user_profile(member.id)
-        theme = await db.get_theme_by_id(profile_settings['theme_id']) or await db.get_theme_by_id(1)
-
-        current_role = next((LEVEL_ROLES[t] for t in sorted(LEVEL_ROLES.keys(), reverse=True) if level_info['level'] >= t), DEFAULT_ROLE_NAME)
-        avatar_bytes = await fetch_avatar(member, 256)
-        
+        # Аватара нет в кэше плиток — скачиваем его параллельно с запросом профиля; при готовой карточке загрузка отменяется
+        avatar_task = None if member.display_avatar.key in avatar_tile_cache.data else asyncio.create_task(get_avatar_tile(member))
+        try:
+            snapshot = await db.get_profile_snapshot(member.id)
+        except BaseException:
+            if avatar_task: avatar_task.cancel()
+            raise
+        level_info, balance, stats, achievements = snapshot['level_info'], snapshot['balance'], snapshot['stats'], snapshot['achievements']
+        theme = await shop_catalog.theme(snapshot['theme_id'])
+
+        current_role = role_name_for_level(level_info['level'], DEFAULT_ROLE_NAME)
         tag = f"{member.name}#{member.discriminator}" if member.discriminator != "0" else member.name
 
-        buf = await asyncio.to_thread(
-            _generate_profile_card_sync,
-            member.display_name, tag, member.id, level_info, balance, stats, achievements[:3], current_role, avatar_bytes, theme
-        )
+        key = _profile_card_key(member.display_name, tag, level_info, balance, stats, achievements[:3], current_role, member.display_avatar.key, theme)
+        png = profile_card_cache.get(key)
+        if png is not None:
+            if avatar_task: avatar_task.cancel()
+        else:
+            avatar_tile = await (avatar_task or get_avatar_tile(member))
+            started = time.perf_counter()
+            buf = await asyncio.to_thread(
+                _generate_profile_card_sync,
+                member.display_name, tag, member.id, level_info, balance, stats, achievements[:3], current_role, avatar_tile, theme
+            )
+            profile_render_stats['renders'] += 1
+            profile_render_stats['render_ms'] += (time.perf_counter() - started) * 1000
+            png = buf.getvalue()
+            profile_card_cache.put(key, png)
         
-        file = discord.File(buf, filename='profile.png')
+        file = discord.File(io.BytesIO(png), filename='profile.png')
         embed = discord.Embed(title=f"🖼️ Профиль {member.display_name}", color=theme['accent_color'])
         embed.set_image(url="attachment://profile.png")
         await ctx.send(embed=embed, file=file)
 
 @bot.command(name="магазин")
 async def shop(ctx):
-    roles = await db.get_shop_roles(ctx.guild.id)
+    roles = await shop_catalog.items(ctx.guild)
     embed = discord.Embed(title="🛒 Магазин ролей", color=discord.Color.blue())
     for item in roles:
         role = ctx.guild.get_role(item['role_id'])
@@ -1247,19 +2565,23 @@ async def shop(ctx):
 
 @bot.command(name="купить")
 async def buy_role(ctx, *, role_name: str):
-    role = discord.utils.get(ctx.guild.roles, name=role_name)
+    item = await shop_catalog.find(ctx.guild, role_name)
+    role = ctx.guild.get_role(item['role_id']) if item else role_index.get(ctx.guild, role_name)
     if not role: return await ctx.send("❌ Роль не найдена.")
-    shop_item = next((i for i in await db.get_shop_roles(ctx.guild.id) if i['role_id'] == role.id), None)
-    if not shop_item: return await ctx.send("❌ Роль не продается.")
-    
-    bal = await db.get_balance(ctx.author.id)
-    if bal < shop_item['price']: return await ctx.send("❌ Недостаточно монет!")
-    if await db.has_role_purchased(ctx.guild.id, ctx.author.id, role.id): return await ctx.send("❌ Роль уже куплена.")
+    if not item: return await ctx.send("❌ Роль не продается.")
+    ok, error, price = await db.buy_shop_role(ctx.guild.id, ctx.author.id, role.id)
+    # Цена и наличие проверяются по shop_roles; если их изменил другой процесс, каталог перечитается
+    if price != item['price']: shop_catalog.invalidate(ctx.guild.id)
+    if not ok: return await ctx.send(error)
     
-    await db.remove_coins(ctx.author.id, shop_item['price'])
-    await db.purchase_role(ctx.guild.id, ctx.author.id, role.id)
-    await ctx.author.add_roles(role, reason="Покупка")
+    try:
+        await ctx.author.add_roles(role, reason="Покупка")
+    except discord.HTTPException as e:
+        await db.refund_shop_role(ctx.guild.id, ctx.author.id, role.id, price)
+        print(f"❌ Не удалось выдать купленную роль {role.name}: {e}")
+        return await ctx.send("❌ Не удалось выдать роль, монеты возвращены.")
     await ctx.send(f"✅ Вы купили роль **{role.name}**!")
+    await achievement_engine.award(ctx.author.id, 'first_purchase', ctx.guild)
 
 @bot.command(name="setup_tickets", aliases=["тикеты"])
 @commands.has_permissions(administrator=True)
@@ -1286,6 +2608,7 @@ async def help_command(ctx):
         "`!статистика [@юзер]` — Подробная текстовая статистика активности\n"
         "`!график [@юзер]` — График вашей активности за последние 30 дней\n"
         "`!rep [@юзер]` (или `+rep`) — Выдать репутацию (раз в 24 часа)\n"
+        "`!топ [голос|сообщения|уровни|монеты|репутация]` — Таблица лидеров\n"
         "`!магазин` — Посмотреть список ролей, доступных для покупки\n"
         "`!купить <название>` — Купить роль за накопленные монеты\n"
         "`!гайд <ссылка_на_game8>` — Полный перевод гайда с сайта Game8"
@@ -1296,13 +2619,91 @@ async def help_command(ctx):
         admin_cmds = (
             "`!ручной_бэкап` (или `!бэкап`) — Сделать бэкап базы данных в Telegram\n"
             "`!setup_tickets` — Разместить панель для создания тикетов\n"
-            "`!канал_гайдов #канал` — Выбрать канал для авто-постинга гайдов Game8"
+            "`!канал_гайдов #канал` — Выбрать канал для авто-постинга гайдов Game8\n"
+            "`!диагностика` — Метрики кэшей и фоновых задач\n"
+            "`!пересчёт_достижений` — Выдать достижения за уже набранную активность\n"
+            "`!аудит_монет [@юзер]` — Баланс и последние операции по журналу монет\n"
+            "`!сверка_монет` — Сверить балансы с журналом и записать корректировки"
         )
         embed.add_field(name="👑 Команды администратора", value=admin_cmds, inline=False)
         
     embed.set_footer(text=f"Бот: {bot.user.name} • Время МСК", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
     await ctx.send(embed=embed)
 
+@bot.command(name="пересчёт_достижений", aliases=["backfill_achievements"])
+@commands.has_permissions(administrator=True)
+async def backfill_achievements(ctx):
+    """Разовая выдача пороговых достижений всем, кто уже набрал нужную активность"""
+    msg = await ctx.send("⏳ Пересчитываю достижения...")
+    await activity_buffer.flush()
+    started = time.perf_counter()
+    users, granted = await achievement_engine.backfill()
+    await msg.edit(content=f"✅ Выдано достижений: **{granted}** для **{users}** пользователей за {time.perf_counter() - started:.1f} с")
+
+@bot.command(name="аудит_монет", aliases=["ledger"])
+@commands.has_permissions(administrator=True)
+async def coin_audit(ctx, member: discord.Member = None):
+    member = member or ctx.author
+    audit = await db.get_coin_audit(member.id)
+    if audit is None: return await ctx.send("❌ База данных недоступна.")
+    status = "✅ сходится" if audit['balance'] == audit['ledger'] else f"⚠️ расхождение {audit['balance'] - audit['ledger']:+,}"
+    lines = [
+        f"`{format_moscow_time(e['created_at'], '%d.%m %H:%M')}` **{e['amount']:+,}** — {e['reason']}" + (f" ({e['ref']})" if e['ref'] else "")
+        for e in audit['entries']
+    ]
+    embed = discord.Embed(title=f"🧾 Журнал монет: {member.display_name}", color=discord.Color.gold())
+    embed.add_field(name="Баланс", value=f"{audit['balance']:,} 🪙", inline=True)
+    embed.add_field(name="По журналу", value=f"{audit['ledger']:,} 🪙 ({status})", inline=True)
+    embed.add_field(name="Ожидает переноса", value=f"{audit['pending']:,} 🪙", inline=True)
+    embed.add_field(name="Последние операции", value="\n".join(lines) or "Операций нет.", inline=False)
+    await ctx.send(embed=embed)
+
+@bot.command(name="сверка_монет", aliases=["reconcile"])
+@commands.has_permissions(administrator=True)
+async def coin_reconcile(ctx):
+    await activity_buffer.flush()
+    users, drift = await db.reconcile_coins()
+    if not users: return await ctx.send("✅ Балансы совпадают с журналом.")
+    await ctx.send(f"⚠️ Расхождения у **{users}** пользователей на **{drift:,}** 🪙 — записаны корректировки `reconcile`.")
+
+@bot.command(name="диагностика", aliases=["perf"])
+@commands.has_permissions(administrator=True)
+async def diagnostics(ctx):
+    """Метрики производительности кэшей и фоновых задач"""
+    embed = discord.Embed(title="🩺 Диагностика", color=discord.Color.dark_grey(), timestamp=get_moscow_time())
+    renders = profile_render_stats['renders']
+    embed.add_field(name="🖼️ Карточки профиля", value=(
+        f"Попадания в кэш: {profile_card_cache.hit_rate:.0%} ({profile_card_cache.hits}/{profile_card_cache.hits + profile_card_cache.misses})\n"
+        f"Отрисовок: {renders}, среднее время: {profile_render_stats['render_ms'] / renders if renders else 0:.0f} мс\n"
+        f"Аватары в кэше: {len(avatar_tile_cache.data)}, попадания: {avatar_tile_cache.hit_rate:.0%}"
+    ), inline=False)
+    embed.add_field(name="📈 Графики", value=f"В кэше: {len(activity_graph_cache.data)}, попадания: {activity_graph_cache.hit_rate:.0%}", inline=False)
+    embed.add_field(name="🎤 Голосовой тик", value=(
+        f"Участников: {voice_tick_stats['members']}, новых уровней: {voice_tick_stats['level_ups']}\n"
+        f"Длительность: {voice_tick_stats['duration_ms']:.0f} мс"
+    ), inline=False)
+    embed.add_field(name="📝 Лог-каналы", value=(
+        f"В очереди: {log_queue.depth}, отправлено сообщений: {log_queue.stats['messages']} "
+        f"({log_queue.stats['embeds']} записей), отброшено: {log_queue.stats['dropped']}"
+    ), inline=False)
+    if telegram.enabled:
+        embed.add_field(name="📱 Telegram", value=(
+            f"В очереди: {telegram.queue_depth}, отправлено: {telegram.stats['sent']}, сводок: {telegram.stats['digests']}\n"
+            f"Повторов после 429: {telegram.stats['retries']}, отброшено: {telegram.stats['dropped']}"
+        ), inline=False)
+    if backup_stats:
+        embed.add_field(name="💾 Последний бэкап", value=(
+            f"{backup_stats['at']}: {backup_stats['raw'] / 1048576:.1f} МБ → {backup_stats['compressed'] / 1048576:.1f} МБ, "
+            f"частей {backup_stats['parts']}, {backup_stats['duration']:.1f} с"
+        ), inline=False)
+    embed.add_field(name="📚 Переводы гайдов", value=(
+        f"Из кэша: {guide_cache_stats['fresh']}, страница не изменилась: {guide_cache_stats['unchanged']}, "
+        f"переведено ИИ: {guide_cache_stats['translated']}\n"
+        f"Последняя публикация: серверов {guide_publish_stats['guilds']}, сообщений {guide_publish_stats['messages']}, "
+        f"{guide_publish_stats['duration_ms'] / 1000:.1f} с (всего гайдов: {guide_publish_stats['guides']})"
+    ), inline=False)
+    await ctx.send(embed=embed)
+
 @bot.command(name="ручной_бэкап", aliases=["бэкап", "backup"])
 @commands.has_permissions(administrator=True)
 async def manual_backup(ctx):
@@ -1311,30 +2712,11 @@ async def manual_backup(ctx):
         return
         
     await ctx.send("⏳ Создаю резервную копию базы данных...")
-    
-    pg_dump_path = subprocess.run(["which", "pg_dump"], capture_output=True, text=True).stdout.strip()
-    if not pg_dump_path:
-        await ctx.send("❌ Утилита `pg_dump` не найдена в системе. Убедитесь, что `postgresql` добавлен в Nixpacks на Railway.")
-        return 
-    
-    db_url = os.environ.get("DATABASE_URL")
-    if not db_url:
-        await ctx.send("❌ Не найдена переменная `DATABASE_URL`.")
-        return
-    
-    filename = f"manual_backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.sql"
-    res = subprocess.run(["pg_dump", db_url, "-T", "user_history", "-f", filename], capture_output=True, text=True)
-    
-    if res.returncode == 0:
-        success = await telegram.send_document(
-            filename, 
-            f"📦 **Ручной бэкап БД**\nЗапросил: {ctx.author.display_name}\nСервер: {ctx.guild.name}\n⏰ {format_moscow_time()}"
-        )
-        os.remove(filename)
-        if success: await ctx.send("✅ Бэкап успешно создан и отправлен в ваш Telegram!")
-        else: await ctx.send("⚠️ Бэкап создан, но произошла ошибка при отправке в Telegram. Проверьте ID чата.")
-    else:
-        await ctx.send(f"❌ Ошибка при создании бэкапа:\n```text\n{res.stderr}\n```")
+    ok, report = await stream_backup(
+        f"📦 **Ручной бэкап БД**\nЗапросил: {ctx.author.display_name}\nСервер: {ctx.guild.name}\n⏰ {format_moscow_time()}"
+    )
+    if ok: await ctx.send(f"✅ Бэкап успешно создан и отправлен в ваш Telegram!\n{report}")
+    else: await ctx.send(report)
 
 @bot.event
 async def on_command_error(ctx, error):